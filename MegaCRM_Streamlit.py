@@ -6,79 +6,26 @@
 # - Month prev/next buttons, filters
 # - Duplicate columns fix
 
-import json, time, urllib.parse
+import os, hashlib
 import streamlit as st
 import pandas as pd
-import gspread
-import gspread.exceptions as gse
-from google.oauth2.service_account import Credentials
 from datetime import datetime, date, timedelta
+from megacrm_core import (
+    EXPORT_FORMATS, FIN_BRANCHES, FIN_CAISSES, FIN_CAISSE_SOURCES, FIN_DEP_COLUMNS, FIN_IMPORT_REQUIRED, FIN_MODES,
+    FIN_MONTHS_FR, FIN_REV_COLUMNS, RECEIVABLE_BUCKETS,
+    background_refresher, client_duplicates, client_picker_index, clients_age, daily_summary, employee_names,
+    fin_append_row, fin_export_year, fin_import, fin_month_title, fin_read_df, fin_read_upload,
+    fin_validate_import, fin_view_rows, fmt_age, fmt_date, load_all_clients, monthly_summary, payment_ledger,
+    perf_trace_begin, perf_trace_end, phone_index, receivables, values_cache, write_queue, year_summary
+)
+
+perf_trace_begin(page="finance")
 
 # ============ Page ============
 st.set_page_config(page_title="Finance — MegaCRM", layout="wide")
 st.markdown("<h1 style='text-align:center'>💸 Finance — Revenus / Dépenses (MB & Bizerte)</h1><hr/>", unsafe_allow_html=True)
 
-# ============ Google Auth ============
-SCOPE = ["https://www.googleapis.com/auth/spreadsheets"]
-
-def make_client_and_sheet_id():
-    try:
-        sa = st.secrets["gcp_service_account"]
-        sa_info = dict(sa) if hasattr(sa, "keys") else (json.loads(sa) if isinstance(sa, str) else {})
-        creds = Credentials.from_service_account_info(sa_info, scopes=SCOPE)
-        client = gspread.authorize(creds)
-        sheet_id = st.secrets["SPREADSHEET_ID"]
-        return client, sheet_id
-    except Exception:
-        creds = Credentials.from_service_account_file("service_account.json", scopes=SCOPE)
-        client = gspread.authorize(creds)
-        sheet_id = "PUT_YOUR_SHEET_ID_HERE"
-        return client, sheet_id
-
-client, SPREADSHEET_ID = make_client_and_sheet_id()
-
-# ============ Constants ============
-FIN_MONTHS_FR = ["Janvier","Février","Mars","Avril","Mai","Juin","Juillet","Aout","Septembre","Octobre","Novembre","Décembre"]
-FIN_REV_COLUMNS = [
-    "Date","Libellé","Prix",
-    "Montant_Admin","Montant_Structure","Montant_PreInscription","Montant_Total",
-    "Echeance","Reste","Mode","Employé","Catégorie","Note"
-]
-FIN_DEP_COLUMNS = ["Date","Libellé","Montant","Caisse_Source","Mode","Employé","Catégorie","Note"]
-
-EXPECTED_HEADERS_CLIENTS = [
-    "Nom & Prénom","Téléphone","Type de contact","Formation",
-    "Remarque","Date ajout","Date de suivi","Alerte",
-    "Inscription","Employe","Tag"
-]
-
-REASSIGN_LOG_SHEET   = "Reassign_Log"
-REASSIGN_LOG_HEADERS = ["timestamp","moved_by","src_employee","dst_employee","client_name","phone"]
-
 # ============ Helpers ============
-def fmt_date(d: date|None) -> str:
-    return d.strftime("%d/%m/%Y") if isinstance(d, date) else ""
-
-def normalize_tn_phone(s: str) -> str:
-    digits = "".join(ch for ch in str(s) if ch.isdigit())
-    if digits.startswith("216"): return digits
-    if len(digits) == 8: return "216" + digits
-    return digits
-
-def fin_month_title(mois: str, kind: str, branch: str) -> str:
-    prefix = "Revenue " if kind == "Revenus" else "Dépense "
-    short  = "MB" if "Menzel" in branch else "BZ"
-    return f"{prefix}{mois} ({short})"
-
-def _to_num(s):
-    return (
-        pd.Series(s).astype(str)
-        .str.replace(" ","",regex=False)
-        .str.replace(",",".",regex=False)
-        .pipe(pd.to_numeric, errors="coerce")
-        .fillna(0.0)
-    )
-
 def _branch_passwords():
     try:
         b = st.secrets["branch_passwords"]
@@ -96,6 +43,21 @@ def emp_pwd_for(emp_name:str)->str:
     except Exception:
         return "1234"
 
+def end_trace():
+    # يسكّر الـtrace متاع الـrerun هذا (زادة قبل st.stop/st.rerun) ويخلّي آخر 5 للوحة الأداء
+    perf = perf_trace_end()
+    if perf:
+        recent = st.session_state.setdefault("perf_recent", [])
+        recent.append(perf)
+        del recent[:-5]
+    return perf
+
+def stop_page():
+    end_trace(); st.stop()
+
+def rerun_page():
+    end_trace(); st.rerun()
+
 # ============ Locks ============
 def admin_unlocked() -> bool:
     ok = st.session_state.get("admin_ok", False)
@@ -106,7 +68,7 @@ def admin_lock_ui():
     with st.sidebar.expander("🔐 إدارة (Admin)", expanded=(not admin_unlocked())):
         if admin_unlocked():
             if st.button("قفل صفحة الأدمِن"):
-                st.session_state["admin_ok"]=False; st.session_state["admin_ok_at"]=None; st.rerun()
+                st.session_state["admin_ok"]=False; st.session_state["admin_ok_at"]=None; rerun_page()
         else:
             admin_pwd = st.text_input("كلمة سرّ الأدمِن", type="password")
             if st.button("فتح صفحة الأدمِن"):
@@ -137,118 +99,24 @@ def emp_lock_ui(emp_name: str):
                 else:
                     st.error("كلمة سرّ غير صحيحة.")
 
-# ============ Sheets Utils ============
-def get_spreadsheet():
-    if st.session_state.get("sh_id") == SPREADSHEET_ID and "sh_obj" in st.session_state:
-        return st.session_state["sh_obj"]
-    last_err = None
-    for i in range(5):
-        try:
-            sh = client.open_by_key(SPREADSHEET_ID)
-            st.session_state["sh_obj"] = sh
-            st.session_state["sh_id"]  = SPREADSHEET_ID
-            return sh
-        except gse.APIError as e:
-            last_err = e
-            time.sleep(0.5 * (2**i))
-    st.error("تعذّر فتح Google Sheet (قد تكون الكوتا تجاوزت الحد).")
-    raise last_err
-
-def ensure_ws(title: str, columns: list[str]):
-    sh = get_spreadsheet()
-    try:
-        ws = sh.worksheet(title)
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title=title, rows="2000", cols=str(max(len(columns), 12)))
-        ws.update("1:1", [columns + [""]*10])
-        return ws
-    header = ws.row_values(1)
-    if header[:len(columns)] != columns or len(header) != len(columns):
-        ws.update("1:1", [columns + [""]*10])
-    return ws
-
-@st.cache_data(ttl=120, show_spinner=False)
-def _read_ws_all_values_cached(title: str, cols: tuple) -> list[list[str]]:
-    ws = ensure_ws(title, list(cols))
-    return ws.get_all_values()
-
-def fin_read_df(title: str, kind: str) -> pd.DataFrame:
-    expected = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
-    values = _read_ws_all_values_cached(title, tuple(expected))
-    if not values:
-        return pd.DataFrame(columns=expected)
-    df = pd.DataFrame(values[1:], columns=values[0] if values else expected)
-    df = df.loc[:, ~df.columns.duplicated()]
-    for col in expected:
-        if col not in df.columns:
-            df[col] = ""
-    df = df[expected]
-    if "Date" in df.columns:
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerce", dayfirst=True)
-    if kind == "Revenus" and "Echeance" in df.columns:
-        df["Echeance"] = pd.to_datetime(df["Echeance"], errors="coerce", dayfirst=True)
-    if kind == "Revenus":
-        for c in ["Prix","Montant_Admin","Montant_Structure","Montant_PreInscription","Montant_Total","Reste"]:
-            df[c] = _to_num(df[c])
-        if "Alert" not in df.columns:
-            df["Alert"] = ""
-        if "Echeance" in df.columns and "Reste" in df.columns:
-            today_ts = pd.Timestamp.now().normalize()
-            ech = pd.to_datetime(df["Echeance"], errors="coerce")
-            reste = pd.to_numeric(df["Reste"], errors="coerce").fillna(0.0)
-            df.loc[ech.notna() & (ech < today_ts) & (reste > 0), "Alert"] = "⚠️ متأخر"
-            df.loc[ech.notna() & (ech.dt.normalize() == today_ts) & (reste > 0), "Alert"] = "⏰ اليوم"
-    else:
-        df["Montant"] = _to_num(df["Montant"])
-    return df
-
-def fin_append_row(title: str, row: dict, kind: str):
-    cols = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
-    ws = ensure_ws(title, cols)
-    header = ws.row_values(1)
-    vals = [str(row.get(col, "")) for col in header]
-    ws.append_row(vals)
-    _read_ws_all_values_cached.clear()
-
-# ============ Load Clients/Employees ============
-@st.cache_data(ttl=600)
-def load_all_clients():
-    sh = get_spreadsheet()
-    dfs, employees = [], []
-    for ws in sh.worksheets():
-        t = ws.title.strip()
-        if t.startswith("Revenue ") or t.startswith("Dépense "): continue
-        if t.endswith("_PAIEMENTS") or t.startswith("_"): continue
-        if t in (REASSIGN_LOG_SHEET,): continue
-        rows = ws.get_all_values()
-        if not rows: 
-            continue
-        header = rows[0]
-        if header[:len(EXPECTED_HEADERS_CLIENTS)] != EXPECTED_HEADERS_CLIENTS:
-            continue
-        employees.append(t)
-        df = pd.DataFrame(rows[1:], columns=header)
-        df["__sheet_name"] = t
-        dfs.append(df)
-    big = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=EXPECTED_HEADERS_CLIENTS+["__sheet_name"])
-    return big, employees
-
-df_clients, all_employes = load_all_clients()
+background_refresher()
 
 # ============ Sidebar: role/employee/branch/month ============
 role = st.sidebar.radio("الدور", ["موظف","أدمن"], horizontal=True, index=0)
 
+# العملاء ما يتحمّلوش هنا: الموظّف يستحق الأسماء برك (metadata)، والـpicker يحمّلهم وقت يتعرض
+all_employes = employee_names() if role == "موظف" else []
 employee = st.sidebar.selectbox("👨‍💼 الموظّف", all_employes) if (role=="موظف" and all_employes) else ""
 if role == "موظف" and employee:
     emp_lock_ui(employee)
     if not emp_unlocked(employee):
         st.info("🔒 أدخل كلمة سرّ الموظّف من اليسار لفتح اللوحة.")
-        st.stop()
+        stop_page()
 
 if role == "أدمن":
     admin_lock_ui()
 
-branch  = st.sidebar.selectbox("🏢 الفرع", ["Menzel Bourguiba","Bizerte"])
+branch  = st.sidebar.selectbox("🏢 الفرع", FIN_BRANCHES)
 kind_ar = st.sidebar.radio("النوع", ["مداخيل","مصاريف"], horizontal=True)
 kind    = "Revenus" if kind_ar=="مداخيل" else "Dépenses"
 
@@ -283,16 +151,11 @@ if not st.session_state[key_pw]:
 
 if not st.session_state.get(key_pw, False):
     st.info("⬅️ أدخل كلمة السرّ من اليسار للمتابعة.")
-    st.stop()
+    stop_page()
 
 # ============ Read current month ============
 fin_title = fin_month_title(mois, kind, branch)
 df_fin = fin_read_df(fin_title, kind)
-df_view = df_fin.copy()
-
-# فلترة حسب الموظّف لو الدور "موظف"
-if role == "موظف" and employee and "Employé" in df_view.columns:
-    df_view = df_view[df_view["Employé"].fillna("").str.strip().str.lower() == employee.strip().lower()]
 
 # ============ Filters ============
 with st.expander("🔎 فلاتر"):
@@ -300,45 +163,35 @@ with st.expander("🔎 فلاتر"):
     date_from = c1.date_input("من تاريخ", value=None)
     date_to   = c2.date_input("إلى تاريخ", value=None)
     search    = c3.text_input("بحث (Libellé/Catégorie/Mode/Note)")
-    if "Date" in df_view.columns:
-        if date_from: df_view = df_view[df_view["Date"] >= pd.to_datetime(date_from)]
-        if date_to:   df_view = df_view[df_view["Date"] <= pd.to_datetime(date_to)]
-    if search and not df_view.empty:
-        m = pd.Series([False]*len(df_view))
-        cols_search = ["Libellé","Catégorie","Mode","Employé","Note","Caisse_Source","Montant_PreInscription"]
-        cols_search = [c for c in cols_search if c in df_view.columns]
-        for c in cols_search:
-            m |= df_view[c].fillna("").astype(str).str.contains(search, case=False, na=False)
-        df_view = df_view[m]
+# الموظّف يشوف عملياتو برك؛ الفلترة ترجع أرقام أسطر فوق الإطار المشترك (بلا نسخة للجلسة)
+rows_view = fin_view_rows(fin_title, df_fin, employee if role == "موظف" else "", date_from, date_to, search)
 
 # ============ Display ============
 st.subheader(f"📄 {fin_title}")
+_fin_err = values_cache().last_error(fin_title)
+if _fin_err:
+    st.warning(f"⚠️ تعذّر الاتصال بـGoogle Sheets — المعروض نسخة محلية ({fmt_age(values_cache().age(fin_title))}).")
+else:
+    st.caption(f"🕒 آخر مزامنة مع Google Sheets: {fmt_age(values_cache().age(fin_title))}")
 if kind=="Revenus":
     cols_show = [c for c in ["Date","Libellé","Prix","Montant_Admin","Montant_Structure","Montant_PreInscription",
-                             "Montant_Total","Echeance","Reste","Alert","Mode","Employé","Catégorie","Note"] if c in df_view.columns]
+                             "Montant_Total","Echeance","Reste","Alert","Mode","Employé","Catégorie","Note"] if c in df_fin.columns]
 else:
-    cols_show = [c for c in ["Date","Libellé","Montant","Caisse_Source","Mode","Employé","Catégorie","Note"] if c in df_view.columns]
+    cols_show = [c for c in ["Date","Libellé","Montant","Caisse_Source","Mode","Employé","Catégorie","Note"] if c in df_fin.columns]
 
-st.dataframe(df_view[cols_show] if not df_view.empty else pd.DataFrame(columns=cols_show), use_container_width=True)
+st.dataframe(df_fin.iloc[rows_view][cols_show] if len(rows_view) else pd.DataFrame(columns=cols_show), use_container_width=True)
+
+writer_id = st.session_state.setdefault("writer_id", os.urandom(6).hex())  # الكتابات المعلّقة متاع الجلسة هاذي
 
 # ============ Admin Summaries ============
+# اللوحات الثقيلة (كل الأشهر/كل العملاء) expanders بـon_change="rerun": Streamlit يشغّل محتوى expander مسكّر،
+# هكّا ما يتحسب كان كي الأدمِن يحلّو
 if role == "أدمن" and admin_unlocked():
     with st.expander("📊 ملخّص الفرع للشهر — Admin Only", expanded=False):
-        rev_df = fin_read_df(fin_month_title(mois,"Revenus",branch), "Revenus")
-        dep_df = fin_read_df(fin_month_title(mois,"Dépenses",branch), "Dépenses")
-        sum_admin  = rev_df["Montant_Admin"].sum() if ("Montant_Admin" in rev_df) else 0.0
-        sum_struct = rev_df["Montant_Structure"].sum() if ("Montant_Structure" in rev_df) else 0.0
-        sum_preins = rev_df["Montant_PreInscription"].sum() if ("Montant_PreInscription" in rev_df) else 0.0
-        sum_total_as = rev_df["Montant_Total"].sum() if ("Montant_Total" in rev_df) else (sum_admin+sum_struct)
-        sum_reste_due= rev_df["Reste"].sum() if ("Reste" in rev_df) else 0.0
-        if not dep_df.empty and "Caisse_Source" in dep_df and "Montant" in dep_df:
-            dep_admin  = dep_df.loc[dep_df["Caisse_Source"]=="Caisse_Admin","Montant"].sum()
-            dep_struct = dep_df.loc[dep_df["Caisse_Source"]=="Caisse_Structure","Montant"].sum()
-            dep_inscr  = dep_df.loc[dep_df["Caisse_Source"]=="Caisse_Inscription","Montant"].sum()
-        else: dep_admin=dep_struct=dep_inscr=0.0
-        reste_admin  = float(sum_admin)  - float(dep_admin)
-        reste_struct = float(sum_struct) - float(dep_struct)
-        reste_inscr  = float(sum_preins) - float(dep_inscr)
+        summ = monthly_summary(branch, mois)
+        sum_admin,  dep_admin,  reste_admin  = (summ["caisses"]["Admin"][k] for k in ("rev","dep","reste"))
+        sum_struct, dep_struct, reste_struct = (summ["caisses"]["Structure"][k] for k in ("rev","dep","reste"))
+        sum_preins, dep_inscr,  reste_inscr  = (summ["caisses"]["Inscription"][k] for k in ("rev","dep","reste"))
         a1,a2,a3 = st.columns(3)
         a1.metric("مداخيل Admin", f"{sum_admin:,.2f}")
         a2.metric("مصاريف Admin", f"{dep_admin:,.2f}")
@@ -352,54 +205,12 @@ if role == "أدمن" and admin_unlocked():
         i2.metric("مصاريف Inscription", f"{dep_inscr:,.2f}")
         i3.metric("Reste Inscription", f"{reste_inscr:,.2f}")
         x1,x2,x3 = st.columns(3)
-        x1.metric("Total Admin+Structure", f"{sum_total_as:,.2f}")
-        x2.metric("Total مصاريف", f"{(dep_admin+dep_struct+dep_inscr):,.2f}")
-        x3.metric("إجمالي Reste Due", f"{sum_reste_due:,.2f}")
+        x1.metric("Total Admin+Structure", f"{summ['total_as']:,.2f}")
+        x2.metric("Total مصاريف", f"{summ['dep_total']:,.2f}")
+        x3.metric("إجمالي Reste Due", f"{summ['reste_due']:,.2f}")
 
     with st.expander("📆 ملخّص يومي — Admin/Structure (Admin Only)", expanded=False):
-        rev_df = fin_read_df(fin_month_title(mois, "Revenus", branch), "Revenus")
-        dep_df = fin_read_df(fin_month_title(mois, "Dépenses", branch), "Dépenses")
-        for dcol in ("Date",):
-            if dcol in rev_df.columns: rev_df[dcol] = pd.to_datetime(rev_df[dcol], errors="coerce")
-            if dcol in dep_df.columns: dep_df[dcol] = pd.to_datetime(dep_df[dcol], errors="coerce")
-        def _num(s): 
-            return pd.to_numeric(pd.Series(s).astype(str).str.replace(" ","",regex=False).str.replace(",",".",regex=False), errors="coerce").fillna(0.0)
-        if not rev_df.empty:
-            if "Montant_Admin" in rev_df:  rev_df["Montant_Admin"]  = _num(rev_df["Montant_Admin"])
-            if "Montant_Structure" in rev_df: rev_df["Montant_Structure"] = _num(rev_df["Montant_Structure"])
-        if not dep_df.empty and "Montant" in dep_df:
-            dep_df["Montant"] = _num(dep_df["Montant"])
-        rev_day = pd.DataFrame(index=pd.to_datetime([]))
-        if not rev_df.empty and "Date" in rev_df.columns:
-            grp_rev = rev_df.groupby(rev_df["Date"].dt.normalize()).agg(
-                Rev_Admin=("Montant_Admin", "sum"),
-                Rev_Structure=("Montant_Structure", "sum"),
-            )
-            rev_day = grp_rev
-        dep_day = pd.DataFrame(index=pd.to_datetime([]))
-        if not dep_df.empty and "Date" in dep_df.columns and "Caisse_Source" in dep_df.columns:
-            dep_admin_day = dep_df.loc[dep_df["Caisse_Source"]=="Caisse_Admin"].groupby(dep_df["Date"].dt.normalize())["Montant"].sum().rename("Dep_Admin")
-            dep_struct_day= dep_df.loc[dep_df["Caisse_Source"]=="Caisse_Structure"].groupby(dep_df["Date"].dt.normalize())["Montant"].sum().rename("Dep_Structure")
-            dep_day = pd.concat([dep_admin_day, dep_struct_day], axis=1)
-        mois_idx = FIN_MONTHS_FR.index(mois) + 1
-        today_year = datetime.now().year
-        start = pd.Timestamp(today_year, mois_idx, 1)
-        end = (start + pd.offsets.MonthEnd(1))
-        full_range = pd.date_range(start, end, freq="D")
-        daily = pd.DataFrame(index=full_range)
-        if not rev_day.empty: daily = daily.join(rev_day, how="left")
-        if not dep_day.empty: daily = daily.join(dep_day, how="left")
-        for c in ["Rev_Admin","Rev_Structure","Dep_Admin","Dep_Structure"]:
-            if c not in daily.columns: daily[c] = 0.0
-            daily[c] = daily[c].fillna(0.0)
-        daily["Reste_Admin_Journalier"]     = daily["Rev_Admin"]     - daily["Dep_Admin"]
-        daily["Reste_Structure_Journalier"] = daily["Rev_Structure"] - daily["Dep_Structure"]
-        daily["Reste_Admin_Cumulé"]     = (daily["Rev_Admin"]     - daily["Dep_Admin"]).cumsum()
-        daily["Reste_Structure_Cumulé"] = (daily["Rev_Structure"] - daily["Dep_Structure"]).cumsum()
-        daily = daily.reset_index().rename(columns={"index":"Date"})
-        cols_order = ["Date","Rev_Admin","Dep_Admin","Reste_Admin_Journalier","Reste_Admin_Cumulé",
-                      "Rev_Structure","Dep_Structure","Reste_Structure_Journalier","Reste_Structure_Cumulé"]
-        daily = daily[cols_order]
+        daily = daily_summary(branch, mois)
         st.dataframe(
             daily.style.format({
                 "Rev_Admin": "{:,.2f}", "Dep_Admin": "{:,.2f}",
@@ -413,70 +224,163 @@ if role == "أدمن" and admin_unlocked():
         st.download_button("⬇️ تنزيل CSV (اليومي Admin/Structure)", data=csv_bytes,
                            file_name=f"daily_summary_{branch}_{mois}.csv", mime="text/csv")
 
+    year_panel = st.expander("📈 لوحة السنة — كل الفروع (Admin Only)", key="year_panel", on_change="rerun")
+    with year_panel:
+        if year_panel.open:
+            y_branches = st.multiselect("الفروع", FIN_BRANCHES, default=FIN_BRANCHES, key="year_branches")
+            ytd_only = st.checkbox("من جانفي إلى الشهر الحالي فقط (YTD)", value=True, key="year_ytd")
+            y_months = FIN_MONTHS_FR[:datetime.now().month] if ytd_only else FIN_MONTHS_FR
+            if y_branches:
+                year = year_summary(y_branches, y_months)
+                num_cols = [c for c in year.columns if c not in ("Branche", "Mois")]
+                tot = year[num_cols].sum()
+                y1, y2, y3 = st.columns(3)
+                for col, name in zip((y1, y2, y3), FIN_CAISSES):
+                    col.metric(f"Reste {name}", f"{tot[f'Reste_{name}']:,.2f}",
+                               help=f"مداخيل {tot[f'Rev_{name}']:,.2f} — مصاريف {tot[f'Dep_{name}']:,.2f}")
+                z1, z2 = st.columns(2)
+                z1.metric("Total Admin+Structure", f"{tot['Total_Admin_Structure']:,.2f}")
+                # Reste في كل سطر = الباقي على العميل بعد الدفعة هاذيكا: المجموع ياخذ آخر Reste لكل عميل (receivables)
+                z2.metric("إجمالي Reste Due", f"{receivables().get(y_branches)['Reste'].sum():,.2f}",
+                          help="آخر Reste لكل عميل، عبر كل الأشهر")
+                by_month = year.groupby("Mois", sort=False)[num_cols].sum().reset_index()
+                st.markdown("**حسب الشهر (الفروع المختارة مجموعة)**")
+                st.dataframe(by_month.style.format({c: "{:,.2f}" for c in num_cols}), use_container_width=True)
+                st.markdown("**حسب الفرع**")
+                by_branch = year.groupby("Branche", sort=False)[num_cols].sum().reset_index()
+                st.dataframe(by_branch.style.format({c: "{:,.2f}" for c in num_cols}), use_container_width=True)
+
+    with st.expander("📦 تصدير كل العمليات — الأشهر الكل (Admin Only)", expanded=False):
+        st.caption("كل أوراق Revenus/Dépenses (الفروع × الأشهر) سطر بسطر في ملف واحد، مع أعمدة Branche/Mois/Type. "
+                   "الملف يتحضّر كي تنزل على الزر.")
+        e1, e2, e3 = st.columns(3)
+        x_fmt = e1.radio("الصيغة", list(EXPORT_FORMATS), horizontal=True, key="export_fmt")
+        x_branches = e2.multiselect("الفروع", FIN_BRANCHES, default=FIN_BRANCHES, key="export_branches")
+        x_kinds = e3.multiselect("النوع", ["Revenus", "Dépenses"], default=["Revenus", "Dépenses"], key="export_kinds")
+        if x_branches and x_kinds:
+            st.download_button(f"⬇️ تنزيل {x_fmt.upper()} (كل العمليات)",
+                               data=lambda: fin_export_year(x_fmt, x_branches, FIN_MONTHS_FR, tuple(x_kinds)),
+                               file_name=f"finance_{datetime.now():%Y%m%d}.{x_fmt}", mime=EXPORT_FORMATS[x_fmt],
+                               on_click="ignore", key="export_go")
+
+    recv_panel = st.expander("💰 المستحقّات والتأخير — كل الأشهر (Admin Only)", key="recv_panel", on_change="rerun")
+    with recv_panel:
+        if recv_panel.open:
+            r_branches = st.multiselect("الفروع", FIN_BRANCHES, default=FIN_BRANCHES, key="recv_branches")
+            if r_branches:
+                recv = receivables().get(r_branches)
+                by_bucket = recv.groupby("Bucket", observed=False)["Reste"].agg(["count", "sum"]).reindex(RECEIVABLE_BUCKETS, fill_value=0)
+                for col, b in zip(st.columns(len(RECEIVABLE_BUCKETS)), RECEIVABLE_BUCKETS):
+                    col.metric(b, f"{by_bucket.loc[b, 'sum']:,.2f}", help=f"{int(by_bucket.loc[b, 'count'])} عميل")
+                st.caption(f"بدون Echeance: {int(recv['Bucket'].isna().sum())} — إجمالي Reste: {recv['Reste'].sum():,.2f}")
+                pick_b = st.multiselect("التأخير", RECEIVABLE_BUCKETS, default=RECEIVABLE_BUCKETS[1:], key="recv_buckets")
+                shown = recv[recv["Bucket"].isin(pick_b)]
+                st.dataframe(shown, use_container_width=True)
+                st.download_button("⬇️ تنزيل CSV (المستحقّات)", data=shown.to_csv(index=False).encode("utf-8-sig"),
+                                   file_name="receivables.csv", mime="text/csv")
+
+    dups_panel = st.expander("📞 أرقام مكرّرة في أوراق الموظفين (Admin Only)", key="dups_panel", on_change="rerun")
+    with dups_panel:
+        if dups_panel.open:
+            across = st.checkbox("بين موظفين مختلفين برك", value=True, key="dups_across")
+            dups = client_duplicates(across_only=across)
+            st.caption(f"أرقام مكرّرة: {dups['Téléphone'].nunique()} — أسطر: {len(dups)} — "
+                       f"منهم تنقلو قبل (Reassign_Log): {dups.loc[dups['Transferts'] > 0, 'Téléphone'].nunique()}")
+            st.dataframe(dups, use_container_width=True, hide_index=True)
+            st.download_button("⬇️ تنزيل CSV (المكرّرين)", data=dups.to_csv(index=False).encode("utf-8-sig"),
+                               file_name="duplicates.csv", mime="text/csv")
+
+    with st.expander(f"📥 استيراد {kind} من ملف CSV/Excel — {branch} (Admin Only)", expanded=False):
+        st.caption("الأعمدة: " + ", ".join(FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS)
+                   + " — كل سطر يتسجّل في ورقة شهر التاريخ متاعو" + (" و Reste يتحسب من الدفعات السابقة للعميل." if kind == "Revenus" else "."))
+        up = st.file_uploader("الملف", type=["csv", "xlsx"], key=f"import_file::{kind}")
+        if up is not None:
+            raw = fin_read_upload(up)
+            missing = [c for c in FIN_IMPORT_REQUIRED[kind] if c not in raw.columns]
+            if missing:
+                st.error("أعمدة ناقصة: " + ", ".join(missing))
+            else:
+                ok_rows, bad_rows = fin_validate_import(raw, kind)
+                st.write(f"✅ صالحة: {len(ok_rows)} — ❌ فيها مشاكل: {len(bad_rows)}")
+                if not bad_rows.empty:
+                    st.dataframe(bad_rows, use_container_width=True)
+                if not ok_rows.empty:
+                    st.dataframe(ok_rows.head(50), use_container_width=True)
+                    # نفس الملف (محتوى) ما يتستوردش مرّتين لنفس الفرع/النوع في الجلسة
+                    imported = st.session_state.setdefault("imported_files", {})
+                    up_key = (hashlib.sha1(up.getvalue()).hexdigest(), kind, branch)
+                    if st.button(f"📤 استيراد {len(ok_rows)} عملية", key=f"import_go::{kind}", disabled=up_key in imported):
+                        imported[up_key] = fin_import(ok_rows, kind, branch, owner=writer_id)
+                    if up_key in imported:
+                        st.success("تسجّلو: " + " — ".join(f"{t}: {n}" for t, n in imported[up_key].items())
+                                   + " — الملف هذا تستورد، الزر تسكّر.")
+
 # ============ Add New Operation ============
 st.markdown("---")
 st.subheader("➕ إضافة عملية جديدة")
 
+def write_status_ui():
+    ops = write_queue().status(writer_id)
+    waiting = [op for op in ops if op["status"] in ("pending", "writing")]
+    failed  = [op for op in ops if op["status"] == "failed"]
+    if waiting:
+        st.info(f"⏳ {len(waiting)} عملية في الانتظار — تتسجّل في Google Sheets بعد لحظات.")
+    if failed:
+        st.error(f"❌ {len(failed)} عملية ما تسجّلتش في Google Sheets:")
+        st.dataframe(pd.DataFrame([{"الورقة": op["title"], "Libellé": op["row"][1], "الخطأ": op["error"]} for op in failed]),
+                     use_container_width=True)
+        b1, b2 = st.columns(2)
+        if b1.button("🔁 إعادة المحاولة", key="write_retry"):
+            write_queue().retry([op["id"] for op in failed]); rerun_page()
+        if b2.button("🗑️ تجاهل", key="write_discard"):
+            write_queue().discard([op["id"] for op in failed]); rerun_page()
+    if not waiting and st.session_state.pop("write_waiting", False):
+        rerun_page()  # الكتابة كملت: الصفحة كاملة (الجدول والملخّصات) تتحدّث
+    st.session_state["write_waiting"] = bool(waiting)
+
+_writes_busy = any(op["status"] in ("pending", "writing") for op in write_queue().status(writer_id))
+st.fragment(write_status_ui, run_every=(2 if _writes_busy else None))()
+
 client_default_lib, client_default_emp = "", (employee or "")
 selected_client_info = None
 paid_so_far_all, last_reste_all = 0.0, 0.0  # عبر كل الأشهر لنفس العميل/الفرع (Revenus)
 
 if kind == "Revenus":
     st.markdown("#### 👤 اربط الدفعة بعميل مُسجَّل (اختياري)")
-    reg = df_clients.copy()
-    reg["Inscr_norm"] = reg["Inscription"].fillna("").astype(str).str.lower().str.strip()
-    reg = reg[reg["Inscr_norm"].isin(["oui","inscrit"])]
+    df_clients, _ = load_all_clients()
+    st.sidebar.caption(f"🕒 العملاء — آخر مزامنة: {fmt_age(clients_age())}")
+    reg_mask = df_clients["Inscr_norm"].isin(["oui","inscrit"])
     if role == "موظف" and employee:
-        reg = reg[reg["__sheet_name"] == employee]
+        reg_mask &= df_clients["__sheet_name"] == employee
+    reg_keys = df_clients["__key"][reg_mask].tolist()
 
-    options, pick = [], None
-    if not reg.empty:
-        def _opt(r):
-            ph = normalize_tn_phone(r.get("Téléphone",""))
-            return f"{r.get('Nom & Prénom','')} — +{ph} — {r.get('Formation','')}  [{r.get('__sheet_name','')}]"
-        options = [_opt(r) for _, r in reg.iterrows()]
-        pick = st.selectbox("اختر عميلًا مُسجَّلًا", ["— بدون اختيار —"]+options)
+    pick = None
+    if reg_keys:
+        picker = client_picker_index(df_clients)
+        pick = st.selectbox("اختر عميلًا مُسجَّلًا", ["— بدون اختيار —"]+reg_keys,
+                            format_func=lambda k: picker["label"].get(k, k))
 
     if pick and pick!="— بدون اختيار —":
-        row = reg.iloc[options.index(pick)]
+        row = df_clients.iloc[picker["pos"][pick]]
         selected_client_info = {
             "name": str(row.get("Nom & Prénom","")).strip(),
-            "tel":  normalize_tn_phone(str(row.get("Téléphone","")).strip()),
+            "tel":  row["Tel_norm"],
             "formation": str(row.get("Formation","")).strip(),
             "emp": str(row.get("__sheet_name","")).strip()
         }
         client_default_lib = f"Paiement {selected_client_info['formation']} - {selected_client_info['name']}"
         if not client_default_emp:
             client_default_emp = selected_client_info["emp"]
+        others = [f"{sh} (سطر {r})" for sh, r in phone_index(df_clients).locate(selected_client_info["tel"])
+                  if (sh, r) != (selected_client_info["emp"], int(row["__row"]))]
+        if others:
+            st.caption("📞 نفس الرقم موجود زادة عند: " + "، ".join(others))
 
-        # دفعات سابقة لنفس الفرع عبر كل الأشهر
-        out = []
+        # دفعات سابقة لنفس الفرع عبر كل الأشهر (من الفهرس)
         try:
-            sh_titles = [w.title for w in get_spreadsheet().worksheets()]
+            prev_df = payment_ledger().lookup(branch, selected_client_info["tel"], client_default_lib)
         except Exception:
-            sh_titles = []
-        months_available = [m for m in FIN_MONTHS_FR if fin_month_title(m, "Revenus", branch) in sh_titles]
-        for m in months_available:
-            t = fin_month_title(m, "Revenus", branch)
-            try:
-                dfm = fin_read_df(t, "Revenus")
-            except Exception:
-                dfm = pd.DataFrame(columns=FIN_REV_COLUMNS)
-            if dfm.empty: 
-                continue
-            dfm = dfm.copy()
-            note_series = dfm["Note"].astype(str) if "Note" in dfm.columns else pd.Series([""]*len(dfm))
-            lib_series = (dfm["Libellé"].astype(str).str.strip().str.lower()
-                          if "Libellé" in dfm.columns else pd.Series([""]*len(dfm)))
-            cond_lib = lib_series.eq(client_default_lib.strip().lower())
-            cond_phone = note_series.str.contains(selected_client_info["tel"], na=False, regex=False)
-            sub = dfm[cond_lib | cond_phone].copy()
-            if not sub.empty:
-                sub["__mois"] = m
-                sub["__sheet_title"] = t
-                out.append(sub)
-        prev_df = pd.concat(out, ignore_index=True) if out else pd.DataFrame(columns=FIN_REV_COLUMNS+["__sheet_title","__mois"])
-        prev_df = prev_df.loc[:, ~prev_df.columns.duplicated()]
+            prev_df = pd.DataFrame(columns=FIN_REV_COLUMNS+["__sheet_title","__mois"])
         st.markdown("#### 💾 دفعات سابقة (كل الأشهر لهذا الفرع)")
         if prev_df.empty:
             st.caption("لا توجد دفعات مسجّلة.")
@@ -519,7 +423,7 @@ with st.form("fin_add_row"):
         reste_after = max(float(prix) - (paid_so_far_month + float(m_total)), 0.0)
 
         e1, e2 = st.columns(2)
-        mode  = e1.selectbox("Mode", ["Espèces","Virement","Carte","Chèque","Autre"])
+        mode  = e1.selectbox("Mode", FIN_MODES)
         cat   = e2.text_input("Catégorie", value="Revenus")
         note_default = f"ClientTel:{selected_client_info['tel']}" if selected_client_info else ""
         note = st.text_area("Note", value=note_default)
@@ -550,13 +454,13 @@ with st.form("fin_add_row"):
                     "Employé": employe.strip(),
                     "Catégorie": cat.strip(),
                     "Note": note.strip(),
-                }, "Revenus")
-                st.success("تمّ الحفظ ✅"); st.cache_data.clear(); st.rerun()
+                }, "Revenus", owner=writer_id)
+                st.toast("✅ تسجّلت العملية — الكتابة في Google Sheets جارية"); rerun_page()
     else:
         c1, c2, c3 = st.columns(3)
         montant = c1.number_input("Montant", min_value=0.0, step=10.0)
-        caisse  = c2.selectbox("Caisse_Source", ["Caisse_Admin","Caisse_Structure","Caisse_Inscription"])
-        mode    = c3.selectbox("Mode", ["Espèces","Virement","Carte","Chèque","Autre"])
+        caisse  = c2.selectbox("Caisse_Source", FIN_CAISSE_SOURCES)
+        mode    = c3.selectbox("Mode", FIN_MODES)
         c4, c5 = st.columns(2)
         cat  = c4.text_input("Catégorie", value="Achat")
         note = c5.text_area("Note (اختياري)")
@@ -577,5 +481,20 @@ with st.form("fin_add_row"):
                     "Employé": employe.strip(),
                     "Catégorie": cat.strip(),
                     "Note": note.strip(),
-                }, "Dépenses")
-                st.success("تمّ الحفظ ✅"); st.cache_data.clear(); st.rerun()
+                }, "Dépenses", owner=writer_id)
+                st.toast("✅ تسجّلت العملية — الكتابة في Google Sheets جارية"); rerun_page()
+
+# ============ Perf ============
+end_trace()
+if role == "أدمن" and admin_unlocked() and st.session_state.get("perf_recent"):
+    with st.sidebar.expander("⏱️ الأداء — آخر التحميلات"):
+        recent = st.session_state["perf_recent"][::-1]
+        i = st.selectbox("التحميل", range(len(recent)), key="perf_pick",
+                         format_func=lambda k: f"{datetime.fromtimestamp(recent[k]['ts']):%H:%M:%S} — {recent[k]['total_ms']:.0f} ms")
+        perf = recent[i]
+        st.caption(f"المجموع: {perf['total_ms']:.0f} ms — طلبات API: {perf['api']} — خارج الـspans (واجهة): {perf['other_ms']:.0f} ms")
+        if perf["spans"]:
+            spans = pd.DataFrame(perf["spans"])
+            spans["name"] = ["· " * d + n for d, n in zip(spans["depth"], spans["name"])]
+            cols = [c for c in ["name","ms","api","cache","rows","start_ms","error"] if c in spans.columns]
+            st.dataframe(spans[cols], use_container_width=True, hide_index=True)
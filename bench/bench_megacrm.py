@@ -0,0 +1,163 @@
+# bench_megacrm.py
+# Benchmark offline لطبقة البيانات (megacrm_core) فوق fake_gspread: أوراق موظفين + أشهر Revenue/Dépense
+# بأحجام 1k..100k سطر، ولكل مسار رئيسي: الوقت (أوّل نداء / نداء ثاني) وعدد طلبات الـAPI.
+#
+#   python bench/bench_megacrm.py --rows 1000 10000 --latency 0.2 --quota 60
+#   python bench/bench_megacrm.py --rows 100000 --months 2 --json bench.json | tee bench_output.txt
+
+import os, sys, json, time, random, shutil, argparse, tempfile, logging
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gspread
+from google.oauth2.service_account import Credentials
+from fake_gspread import FakeSheetsHTTP, fake_client
+
+# megacrm_core يعمل authorize وقت أوّل طلب: الـfake يتحط قبل
+CURRENT = {"http": FakeSheetsHTTP()}
+gspread.authorize = lambda creds: fake_client(CURRENT["http"])
+Credentials.from_service_account_info = classmethod(lambda cls, *a, **k: None)
+Credentials.from_service_account_file = classmethod(lambda cls, *a, **k: None)
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+import streamlit as st
+import megacrm_core as core
+
+FORMATIONS = ["Python", "Excel", "Comptabilité", "Anglais", "Marketing", "Photoshop"]
+
+def build_dataset(http: FakeSheetsHTTP, rows: int, months: int, employees: int, clients: int, seed: int = 1) -> list[dict]:
+    # ترجع قائمة العملاء (للـlookup)؛ الأشهر = آخر `months` أشهر لين الشهر الحالي، للفرعين
+    rnd = random.Random(seed)
+    names = [f"Emp{i:02d}" for i in range(employees)]
+    people = []
+    for i in range(clients):
+        people.append({"name": f"Client {i}", "tel": f"{rnd.randrange(20000000, 99999999)}",
+                       "formation": rnd.choice(FORMATIONS), "emp": names[i % employees]})
+    for emp in names:
+        tab = [core.EXPECTED_HEADERS_CLIENTS]
+        for p in people:
+            if p["emp"] == emp:
+                tab.append([p["name"], p["tel"], "Appel", p["formation"], "", "01/01/2025", "", "",
+                            rnd.choice(["Oui", "Non", "inscrit", ""]), emp, ""])
+        http.add_sheet(emp, tab)
+    http.add_sheet(core.REASSIGN_LOG_SHEET, [core.REASSIGN_LOG_HEADERS])
+    cur = date.today().month
+    year = date.today().year
+    for branch in core.FIN_BRANCHES:
+        for m in range(max(1, cur - months + 1), cur + 1):
+            mois = core.FIN_MONTHS_FR[m-1]
+            rev = [core.FIN_REV_COLUMNS]
+            for _ in range(rows):
+                p = rnd.choice(people)
+                adm, struct = rnd.choice([50, 100, 150]), rnd.choice([0, 50, 100])
+                day = f"{rnd.randint(1, 28):02d}/{m:02d}/{year}"
+                note = f"ClientTel:216{p['tel']}" if rnd.random() < 0.7 else ""
+                rev.append([day, f"Paiement {p['formation']} - {p['name']}", "900", str(adm), str(struct), "0",
+                            str(adm+struct), day, str(900-adm-struct), "Espèces", p["emp"], "Revenus", note])
+            http.add_sheet(core.fin_month_title(mois, "Revenus", branch), rev)
+            dep = [core.FIN_DEP_COLUMNS]
+            for _ in range(max(rows // 5, 1)):
+                day = f"{rnd.randint(1, 28):02d}/{m:02d}/{year}"
+                dep.append([day, "Achat", str(rnd.choice([10, 20, 50])), rnd.choice(core.FIN_CAISSE_SOURCES),
+                            "Espèces", rnd.choice(names), "Achat", ""])
+            http.add_sheet(core.fin_month_title(mois, "Dépenses", branch), dep)
+    return people
+
+def reset_state(http: FakeSheetsHTTP, workdir: str):
+    # process "جديد": كل الـcache_resource يتفسخو، والـsnapshots في دوسي فارغ
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    st.cache_resource.clear()
+    CURRENT["http"] = http
+
+def api_calls(http: FakeSheetsHTTP) -> int:
+    return sum(n for k, n in http.calls.items() if k not in ("429", "503"))
+
+def measure(http: FakeSheetsHTTP, fn) -> dict:
+    before, errs = api_calls(http), http.calls["429"] + http.calls["503"]
+    t0 = time.perf_counter()
+    try:
+        n, error = fn(), None
+    except Exception as e:
+        n, error = 0, f"{type(e).__name__}: {e}"  # الـretry متاع الـgateway ما كفّاش: نسجّلو ونكمّلو
+    return {"s": time.perf_counter() - t0, "api": api_calls(http) - before,
+            "throttled": http.calls["429"] + http.calls["503"] - errs, "rows": n, "error": error}
+
+def paths(people: list[dict], saves: int) -> list[tuple[str, object]]:
+    mois = core.FIN_MONTHS_FR[date.today().month - 1]
+    branch = core.FIN_BRANCHES[0]
+    title = core.fin_month_title(mois, "Revenus", branch)
+    p = people[0]
+    lib = f"Paiement {p['formation']} - {p['name']}"
+
+    def save():
+        for i in range(saves):
+            core.fin_append_row(title, {"Date": date.today().strftime("%d/%m/%Y"), "Libellé": f"Bench {i}",
+                                        "Prix": "900.00", "Montant_Total": "100.00", "Reste": "800.00"}, "Revenus")
+        core.write_queue().flush()
+        return saves
+
+    return [
+        ("load_all_clients", lambda: len(core.load_all_clients()[0])),
+        ("fin_read_df",      lambda: len(core.fin_read_df(title, "Revenus"))),
+        ("history_lookup",   lambda: len(core.payment_ledger().lookup(branch, core.normalize_tn_phone(p["tel"]), lib))),
+        ("monthly_summary",  lambda: len(core.monthly_summary(branch, mois)["caisses"])),
+        ("daily_summary",    lambda: len(core.daily_summary(branch, mois))),
+        ("year_summary",     lambda: len(core.year_summary())),
+        ("receivables",      lambda: len(core.receivables().get())),
+        ("save",             save),
+    ]
+
+def run(args) -> list[dict]:
+    results = []
+    workdir = os.path.join(tempfile.gettempdir(), "megacrm_bench")
+    for rows in args.rows:
+        http = FakeSheetsHTTP(latency=args.latency, per_1k_rows=args.per_1k_rows,
+                              quota_per_min=args.quota, error_rate=args.error_rate, seed=args.seed)
+        people = build_dataset(http, rows, args.months, args.employees, args.clients or rows, args.seed)
+        http.calls.clear()
+        reset_state(http, workdir)
+        for name, fn in paths(people, args.saves):
+            first = measure(http, fn)
+            again = measure(http, fn) if name != "save" else None
+            results.append({"rows": rows, "path": name, "first_s": first["s"], "first_api": first["api"],
+                            "repeat_s": again and again["s"], "repeat_api": again and again["api"],
+                            "throttled": first["throttled"] + (again["throttled"] if again else 0),
+                            "items": first["rows"], "error": first["error"] or (again and again["error"])})
+    os.chdir(ROOT)
+    return results
+
+def report(results: list[dict]):
+    print(f"{'rows':>7}  {'path':<17} {'first s':>9} {'api':>4}  {'repeat s':>9} {'api':>4}  {'429/5xx':>7}  {'items':>7}")
+    for r in results:
+        rep_s = f"{r['repeat_s']:9.3f}" if r["repeat_s"] is not None else f"{'—':>9}"
+        rep_a = f"{r['repeat_api']:4d}" if r["repeat_api"] is not None else f"{'—':>4}"
+        print(f"{r['rows']:>7}  {r['path']:<17} {r['first_s']:9.3f} {r['first_api']:4d}  {rep_s} {rep_a}  {r['throttled']:7d}  {r['items']:7d}"
+              + (f"  ! {r['error']}" if r["error"] else ""))
+
+def main():
+    ap = argparse.ArgumentParser(description="MegaCRM finance data-layer benchmark (offline, fake Google Sheets)")
+    ap.add_argument("--rows", type=int, nargs="+", default=[1000, 10000], help="أسطر في كل ورقة Revenue (Dépense = rows/5)")
+    ap.add_argument("--months", type=int, default=3, help="عدد الأشهر المعبّية لكل فرع (لين الشهر الحالي)")
+    ap.add_argument("--employees", type=int, default=10)
+    ap.add_argument("--clients", type=int, default=0, help="عدد العملاء (افتراضي = rows)")
+    ap.add_argument("--saves", type=int, default=20, help="عمليات في مسار save (تتكتب بـflush واحد)")
+    ap.add_argument("--latency", type=float, default=0.15, help="ثواني لكل طلب API")
+    ap.add_argument("--per-1k-rows", type=float, default=0.02, help="ثواني زايدة لكل 1000 سطر راجعين")
+    ap.add_argument("--quota", type=int, default=None, help="كوتا الطلبات/دقيقة في الـfake (429 كي تتجاوز)")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="نسبة 503 عشوائية")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="نكتبو النتائج JSON في الملف هذا زادة")
+    args = ap.parse_args()
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# fake_gspread.py
+# Google Sheets في الذاكرة على مستوى HTTPClient متاع gspread: Spreadsheet/Worksheet الحقيقيين يخدمو فوقو،
+# وكل نداء API يتحسب (calls) مع latency وكوتا 429 قابلين للتعديل. بلا شبكة.
+
+import re, time, random, threading
+from collections import Counter, OrderedDict, deque
+import gspread
+from gspread.http_client import HTTPClient
+
+def _col_num(letters: str) -> int:
+    n = 0
+    for ch in letters:
+        n = n*26 + (ord(ch) - 64)
+    return n
+
+def parse_a1(rng: str) -> tuple[str, int, int, int|None, int|None]:
+    # "'Title'!A5:M" -> (title, row0, col0, row1|None, col1|None) — كلّهم 1-based
+    title, _, a1 = rng.rpartition("!") if "!" in rng else (rng, "", "")
+    if title.startswith("'"):
+        title = title[1:-1].replace("''", "'")
+    if not a1:
+        return title, 1, 1, None, None
+    def cell(s):
+        m = re.match(r"([A-Z]*)(\d*)$", s)
+        return (int(m.group(2)) if m.group(2) else None), (_col_num(m.group(1)) if m.group(1) else None)
+    parts = a1.split(":")
+    (r0, c0), (r1, c1) = cell(parts[0]), cell(parts[-1])
+    return title, r0 or 1, c0 or 1, r1, c1
+
+class _Response:
+    # أدنى حاجة يستحقها gse.APIError
+    def __init__(self, status: int, message: str):
+        self.status_code, self.text, self.headers = status, message, {}
+        self._message = message
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self._message, "status": "FAKE"}}
+
+class FakeSheetsHTTP(HTTPClient):
+    # latency: ثواني لكل طلب، per_1k_rows: ثواني زايدة لكل 1000 سطر راجعين،
+    # quota_per_min: كوتا القراءة+الكتابة (نافذة 60 ثانية) -> 429، error_rate: نسبة 503 عشوائية
+    def __init__(self, latency: float = 0.0, per_1k_rows: float = 0.0, quota_per_min: int|None = None,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.latency, self.per_1k_rows = latency, per_1k_rows
+        self.quota_per_min, self.error_rate = quota_per_min, error_rate
+        self.sheets = OrderedDict()  # title -> {"id", "rows"}
+        self.calls = Counter()
+        self._window = deque()
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._rng = random.Random(seed)
+
+    def request(self, *args, **kwargs):
+        raise RuntimeError("fake_gspread: no network")
+
+    # ---- data ----
+    def add_sheet(self, title: str, rows: list[list[str]]):
+        with self._lock:
+            self.sheets[title] = {"id": self._next_id, "rows": [list(r) for r in rows]}
+            self._next_id += 1
+
+    def rows(self, title: str) -> list[list[str]]:
+        return self.sheets[title]["rows"]
+
+    def _slice(self, rng: str) -> list[list[str]]:
+        title, r0, c0, r1, c1 = parse_a1(rng)
+        if title not in self.sheets:
+            raise gspread.exceptions.APIError(_Response(400, f"Unable to parse range: {rng}"))
+        out = []
+        for r in self.sheets[title]["rows"][r0-1:r1]:
+            r = r[c0-1:c1]
+            while r and r[-1] == "":
+                r = r[:-1]  # كيف الـAPI: الخلايا الفارغة في الآخر ما ترجعش
+            out.append(r)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    # ---- simulation ----
+    def _call(self, name: str, rows_out: int = 0):
+        now = time.monotonic()
+        with self._lock:
+            self.calls[name] += 1
+            if self.quota_per_min is not None:
+                while self._window and now - self._window[0] > 60:
+                    self._window.popleft()
+                if len(self._window) >= self.quota_per_min:
+                    self.calls["429"] += 1
+                    raise gspread.exceptions.APIError(_Response(429, "Quota exceeded (fake)"))
+                self._window.append(now)
+            fail = self.error_rate and self._rng.random() < self.error_rate
+        if fail:
+            self.calls["503"] += 1
+            raise gspread.exceptions.APIError(_Response(503, "Service unavailable (fake)"))
+        delay = self.latency + self.per_1k_rows * rows_out / 1000
+        if delay:
+            time.sleep(delay)
+
+    # ---- HTTPClient API ----
+    def fetch_sheet_metadata(self, id, params=None):
+        self._call("fetch_sheet_metadata")
+        return {"spreadsheetId": id, "properties": {"title": "Fake MegaCRM"},
+                "sheets": [{"properties": {"sheetId": s["id"], "title": t, "index": i, "sheetType": "GRID",
+                                           "gridProperties": {"rowCount": max(len(s["rows"]), 1000), "columnCount": 26}}}
+                           for i, (t, s) in enumerate(self.sheets.items())]}
+
+    def spreadsheets_get(self, id, params=None):
+        return self.fetch_sheet_metadata(id, params)
+
+    def values_get(self, id, range, params=None):
+        values = self._slice(range)
+        self._call("values_get", len(values))
+        return {"range": range, "majorDimension": "ROWS", "values": values}
+
+    def values_batch_get(self, id, ranges, params=None):
+        out = [{"range": r, "values": self._slice(r)} for r in ranges]
+        self._call("values_batch_get", sum(len(v["values"]) for v in out))
+        return {"spreadsheetId": id, "valueRanges": out}
+
+    def values_append(self, id, range, params, body):
+        self._call("values_append")
+        title = parse_a1(range)[0]
+        new = [[str(x) for x in r] for r in body["values"]]
+        with self._lock:
+            rows = self.sheets[title]["rows"]
+            start = len(rows) + 1
+            rows.extend(new)
+        return {"updates": {"updatedRange": f"'{title}'!A{start}:Z{start+len(new)-1}", "updatedRows": len(new)}}
+
+    def values_update(self, id, range, params=None, body=None):
+        self._call("values_update")
+        title, r0, *_ = parse_a1(range)
+        with self._lock:
+            rows = self.sheets[title]["rows"]
+            for i, r in enumerate(body["values"]):
+                while len(rows) < r0 + i:
+                    rows.append([])
+                rows[r0-1+i] = [str(x) for x in r]
+        return {"updatedRange": range}
+
+    def batch_update(self, id, body):
+        self._call("batch_update")
+        replies = []
+        for req in body.get("requests", []):
+            if "addSheet" in req:
+                title = req["addSheet"]["properties"]["title"]
+                self.add_sheet(title, [])
+                s = self.sheets[title]
+                replies.append({"addSheet": {"properties": {"sheetId": s["id"], "title": title, "index": len(self.sheets)-1,
+                                                            "sheetType": "GRID", "gridProperties": {"rowCount": 1000, "columnCount": 26}}}})
+            else:
+                replies.append({})
+        return {"replies": replies}
+
+def fake_client(http: FakeSheetsHTTP) -> gspread.Client:
+    return gspread.Client(None, http_client=lambda auth, session=None: http)
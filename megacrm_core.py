@@ -0,0 +1,1852 @@
+# megacrm_core.py
+# طبقة البيانات متاع Finance_App (بلا واجهة): Google Sheets (gateway، كاش، snapshots، طابور الكتابة)،
+# الإطارات المحوّلة، الملخّصات، الاستيراد والمستحقّات. MegaCRM_Streamlit.py يستعملها، وbench/ يشغّلها بلا شبكة.
+
+import os, json, re, time, random, atexit, sqlite3, tempfile, threading, functools, logging
+from logging.handlers import RotatingFileHandler
+import streamlit as st
+import pandas as pd
+import numpy as np
+from pandas.api.types import union_categoricals
+import gspread
+import gspread.exceptions as gse
+import requests
+from google.oauth2.service_account import Credentials
+from datetime import datetime, date
+from concurrent.futures import ThreadPoolExecutor
+
+# ============ Google Auth ============
+SCOPE = ["https://www.googleapis.com/auth/spreadsheets"]
+
+def make_client_and_sheet_id():
+    try:
+        sa = st.secrets["gcp_service_account"]
+        sa_info = dict(sa) if hasattr(sa, "keys") else (json.loads(sa) if isinstance(sa, str) else {})
+        creds = Credentials.from_service_account_info(sa_info, scopes=SCOPE)
+        client = gspread.authorize(creds)
+        sheet_id = st.secrets["SPREADSHEET_ID"]
+        return client, sheet_id
+    except Exception:
+        creds = Credentials.from_service_account_file("service_account.json", scopes=SCOPE)
+        client = gspread.authorize(creds)
+        sheet_id = "PUT_YOUR_SHEET_ID_HERE"
+        return client, sheet_id
+
+# client/spreadsheet مشتركين على مستوى الـprocess (مش لكل جلسة ولا لكل rerun)،
+# ويتعملو وقت أوّل حاجة تستحقهم (مش وقت الـimport): شاشات كلمة السرّ ما تستنّاش الـauth
+@st.cache_resource(show_spinner=False)
+def get_client_and_sheet_id():
+    return make_client_and_sheet_id()
+
+def spreadsheet_id() -> str:
+    return get_client_and_sheet_id()[1]
+
+# ============ Constants ============
+FIN_BRANCHES  = ["Menzel Bourguiba","Bizerte"]
+FIN_MONTHS_FR = ["Janvier","Février","Mars","Avril","Mai","Juin","Juillet","Aout","Septembre","Octobre","Novembre","Décembre"]
+FIN_REV_COLUMNS = [
+    "Date","Libellé","Prix",
+    "Montant_Admin","Montant_Structure","Montant_PreInscription","Montant_Total",
+    "Echeance","Reste","Mode","Employé","Catégorie","Note"
+]
+FIN_DEP_COLUMNS = ["Date","Libellé","Montant","Caisse_Source","Mode","Employé","Catégorie","Note"]
+# schema: كيفاش يتحوّل كل عمود من النص الخام (مبالغ float64، تواريخ datetime64، قوائم صغيرة category)
+FIN_AMOUNT_COLS   = ["Prix","Montant_Admin","Montant_Structure","Montant_PreInscription","Montant_Total","Reste","Montant"]
+FIN_DATE_COLS     = ["Date","Echeance"]
+FIN_CATEGORY_COLS = ["Mode","Employé","Catégorie","Caisse_Source","Alert"]
+FIN_CAISSE_SOURCES = ["Caisse_Admin","Caisse_Structure","Caisse_Inscription"]
+FIN_MODES          = ["Espèces","Virement","Carte","Chèque","Autre"]
+
+EXPECTED_HEADERS_CLIENTS = [
+    "Nom & Prénom","Téléphone","Type de contact","Formation",
+    "Remarque","Date ajout","Date de suivi","Alerte",
+    "Inscription","Employe","Tag"
+]
+
+REASSIGN_LOG_SHEET   = "Reassign_Log"
+REASSIGN_LOG_HEADERS = ["timestamp","moved_by","src_employee","dst_employee","client_name","phone"]
+
+# ============ Helpers ============
+def fmt_date(d: date|None) -> str:
+    return d.strftime("%d/%m/%Y") if isinstance(d, date) else ""
+
+def normalize_tn_phone(s: str) -> str:
+    digits = "".join(ch for ch in str(s) if ch.isdigit())
+    if digits.startswith("216"): return digits
+    if len(digits) == 8: return "216" + digits
+    return digits
+
+def normalize_tn_phone_series(s: pd.Series) -> pd.Series:
+    # نفس normalize_tn_phone لكن vectorized
+    digits = s.fillna("").astype(str).str.replace(r"\D", "", regex=True)
+    return digits.where(digits.str.startswith("216") | (digits.str.len() != 8), "216" + digits)
+
+def fin_month_title(mois: str, kind: str, branch: str) -> str:
+    prefix = "Revenue " if kind == "Revenus" else "Dépense "
+    short  = "MB" if "Menzel" in branch else "BZ"
+    return f"{prefix}{mois} ({short})"
+
+# ============ Sheets Utils ============
+class SingleFlight:
+    # طلب واحد لكل مفتاح: الجلسات اللي توصل في نفس الوقت تستنّى نتيجة نفس الطلب
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+        return call["result"]
+
+    def busy(self, key) -> bool:
+        return key in self._calls
+
+@st.cache_resource(show_spinner=False)
+def single_flight() -> SingleFlight:
+    return SingleFlight()
+
+_call_ctx = threading.local()  # background=True: الطلبات متاع الـthreads الخلفية أولويتها أقل
+
+def in_background() -> bool:
+    return getattr(_call_ctx, "background", False)
+
+def run_in_background(key, fn):
+    # تحديث في thread منفصل؛ لو نفس المفتاح يخدم توّا ما نعاودوش
+    if single_flight().busy(key):
+        return
+    def _run():
+        _call_ctx.background = True
+        try:
+            single_flight().do(key, fn)
+        except Exception:
+            pass  # الخطأ يتسجّل في الكاش (last_error) والقيم القديمة تبقى
+    threading.Thread(target=_run, daemon=True).start()
+
+# ============ Perf ============
+PERF_LOG_BYTES = 2_000_000  # perf.log يدور كي يوصل 2MB، ونخلّيو 5 نسخ قدام
+PERF_LOG_KEEP  = 5
+
+def _perf_log_path() -> str:
+    try:
+        return str(st.secrets.get("perf_log", ".megacrm_cache/perf.log"))
+    except Exception:
+        return ".megacrm_cache/perf.log"
+
+@st.cache_resource(show_spinner=False)
+def perf_logger() -> logging.Logger:
+    # سطر JSON لكل rerun (ولكل span من الـthreads الخلفية) -> تحليل على مدى أيام
+    path = _perf_log_path()
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    log = logging.getLogger("megacrm.perf")
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    if not log.handlers:
+        h = RotatingFileHandler(path, maxBytes=PERF_LOG_BYTES, backupCount=PERF_LOG_KEEP, encoding="utf-8")
+        h.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(h)
+    return log
+
+def _perf_emit(record: dict):
+    try:
+        perf_logger().info(json.dumps(record, ensure_ascii=False, default=str))
+    except Exception:
+        pass  # القياس ما يطيّحش الصفحة
+
+def _api_counter() -> list[int]:
+    # عدّاد طلبات الـAPI متاع الـthread (workers متاع batch_get_values يشاركوه)
+    c = getattr(_call_ctx, "api", None)
+    if c is None:
+        c = _call_ctx.api = [0]
+    return c
+
+def _rows_of(result) -> int|None:
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    return len(result) if isinstance(result, (pd.DataFrame, list)) else None
+
+class perf_span:
+    # with perf_span("name") as rec: وقت + طلبات API + cache (perf_note) + أسطر. الـspans تتجمّع في trace
+    # متاع الـrerun (perf_trace_begin/end)، وإلا (thread خلفي) الـspan اللي في الأعلى يتكتب وحدو في اللوغ
+    def __init__(self, name: str, **attrs):
+        self.rec = {"name": name, **attrs}
+
+    def __enter__(self) -> dict:
+        stack = _call_ctx.__dict__.setdefault("spans", [])
+        trace = getattr(_call_ctx, "trace", None)
+        self._t0, self._api0 = time.perf_counter(), _api_counter()[0]
+        self.rec.update(depth=len(stack), start_ms=round((self._t0 - trace["t0"]) * 1000, 1) if trace else 0.0)
+        stack.append(self.rec)
+        if trace is not None:
+            trace["spans"].append(self.rec)  # بترتيب الدخول: الأب قبل أولادو
+        return self.rec
+
+    def __exit__(self, exc_type, exc, tb):
+        _call_ctx.spans.pop()
+        self.rec["ms"] = round((time.perf_counter() - self._t0) * 1000, 1)
+        self.rec["api"] = _api_counter()[0] - self._api0
+        if exc_type is not None:
+            self.rec["error"] = exc_type.__name__
+        if getattr(_call_ctx, "trace", None) is None and self.rec["depth"] == 0:
+            _perf_emit({"ts": time.time(), "kind": "span", "thread": threading.current_thread().name, **self.rec})
+        return False
+
+def perf_note(**attrs):
+    # يزيد معلومات (cache/rows...) للـspan المفتوح توّا
+    stack = getattr(_call_ctx, "spans", None)
+    if stack:
+        stack[-1].update(attrs)
+
+def traced(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with perf_span(name) as rec:
+                out = fn(*args, **kwargs)
+                rows = _rows_of(out)
+                if rows is not None:
+                    rec.setdefault("rows", rows)
+                return out
+        return wrapper
+    return deco
+
+def perf_trace_begin(**attrs):
+    _call_ctx.spans = []
+    _call_ctx.trace = {"t0": time.perf_counter(), "api0": _api_counter()[0], "spans": [], **attrs}
+
+def perf_trace_end() -> dict|None:
+    # يسكّر الـtrace متاع الـrerun: المجموع، الـAPI، والوقت اللي برّا الـspans (واجهة/عرض) + سطر في اللوغ
+    trace = getattr(_call_ctx, "trace", None)
+    if trace is None:
+        return None
+    _call_ctx.trace = None
+    total = (time.perf_counter() - trace.pop("t0")) * 1000
+    top = sum(r.get("ms", 0.0) for r in trace["spans"] if r["depth"] == 0)
+    out = dict(trace, ts=time.time(), kind="rerun", total_ms=round(total, 1),
+               api=_api_counter()[0] - trace.pop("api0"), other_ms=round(max(total - top, 0.0), 1))
+    _perf_emit(out)
+    return out
+
+# ============ Sheets Gateway ============
+SHEETS_RATE_PER_MIN = 60   # كوتا Google: 60 طلب/دقيقة لكل مستخدم (الـservice account)
+SHEETS_BURST        = 15
+WRITE_RESERVE       = 2    # tokens ما تاخذهمش القراءة: الحفظ ما يستنّاش الـdashboards
+BACKGROUND_RESERVE  = 5    # والتحديث الخلفي يخلّي زادة بلاصة للقراءة متاع الجلسات
+RETRY_MAX     = 5
+RETRY_BASE    = 1.0
+RETRY_CAP     = 16.0
+RETRY_CODES   = {429, 500, 502, 503, 504}
+PRIO_WRITE, PRIO_READ, PRIO_BACKGROUND = 0, 1, 2
+
+def _sheets_quota() -> tuple[float, int]:
+    try:
+        q = st.secrets["sheets_quota"]
+        return float(q.get("per_min", SHEETS_RATE_PER_MIN)), int(q.get("burst", SHEETS_BURST))
+    except Exception:
+        return SHEETS_RATE_PER_MIN, SHEETS_BURST
+
+def _api_status(e: gse.APIError) -> int:
+    code = getattr(e, "code", -1)
+    if code in (None, -1):
+        code = getattr(getattr(e, "response", None), "status_code", -1)
+    return int(code or -1)
+
+def _retry_after(e: gse.APIError) -> float|None:
+    try:
+        return float(e.response.headers.get("Retry-After"))
+    except Exception:
+        return None
+
+class SheetsGateway:
+    # كل نداء gspread يتعدّى من هنا: token bucket واحد للـprocess كامل، الكتابة قبل القراءة
+    # والقراءة قبل التحديث الخلفي، وretry واحد (backoff + jitter) على 429/5xx
+    def __init__(self, per_min: float, burst: int):
+        self.rate = per_min / 60.0
+        self.capacity = float(burst)
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = [0, 0, 0]  # عدد اللي يستنّاو في كل أولوية
+        self._cond = threading.Condition()
+        self.stats = {"calls": 0, "writes": 0, "retries": 0, "throttled": 0, "wait_s": 0.0}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _need(self, prio: int) -> float:
+        need = 1.0 + (0 if prio == PRIO_WRITE else WRITE_RESERVE) + (BACKGROUND_RESERVE if prio == PRIO_BACKGROUND else 0)
+        return min(need, self.capacity)
+
+    def _acquire(self, prio: int):
+        t0 = time.monotonic()
+        with self._cond:
+            self._waiting[prio] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    ahead = any(self._waiting[:prio])
+                    if not ahead and now >= self._paused_until and self._tokens >= self._need(prio):
+                        self._tokens -= 1.0
+                        break
+                    wait = max(self._paused_until - now, (self._need(prio) - self._tokens) / self.rate, 0.05)
+                    self._cond.wait(timeout=min(wait, 1.0))
+            finally:
+                self._waiting[prio] -= 1
+                self._cond.notify_all()
+        waited = time.monotonic() - t0
+        if waited > 0.05:
+            self.stats["throttled"] += 1
+            self.stats["wait_s"] += waited
+
+    def _backoff(self, attempt: int, e: Exception|None = None) -> float:
+        delay = min(RETRY_CAP, RETRY_BASE * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        hint = _retry_after(e) if isinstance(e, gse.APIError) else None
+        return max(delay, hint or 0.0)
+
+    def _throttle(self, delay: float):
+        # 429 = الكوتا كملت للـprocess كامل: نوقّفو الكل موش كان الطلب هذا
+        with self._cond:
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._cond.notify_all()
+
+    def call(self, kind: str, fn, *args, idempotent: bool = True, **kwargs):
+        # kind: "read" ولا "write". idempotent=False (append): ما نعاودوش على 5xx/انقطاع، خاطر
+        # الطلب ينجم يكون تكتب -> نعاودو كان على 429 (Google رفضو قبل ما يتنفّذ)
+        prio = PRIO_WRITE if kind == "write" else (PRIO_BACKGROUND if in_background() else PRIO_READ)
+        for attempt in range(RETRY_MAX):
+            self._acquire(prio)
+            self.stats["calls"] += 1
+            _api_counter()[0] += 1
+            self.stats["writes"] += kind == "write"
+            try:
+                return fn(*args, **kwargs)
+            except gse.APIError as e:
+                status = _api_status(e)
+                if status not in RETRY_CODES or (status != 429 and not idempotent) or attempt == RETRY_MAX - 1:
+                    raise
+                delay = self._backoff(attempt, e)
+                if status == 429:
+                    self._throttle(delay)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if not idempotent or attempt == RETRY_MAX - 1:
+                    raise
+                delay = self._backoff(attempt)
+            self.stats["retries"] += 1
+            time.sleep(delay)
+
+@st.cache_resource(show_spinner=False)
+def sheets_gateway() -> SheetsGateway:
+    return SheetsGateway(*_sheets_quota())
+
+def sheets_call(kind: str, fn, *args, **kwargs):
+    return sheets_gateway().call(kind, fn, *args, **kwargs)
+
+@st.cache_resource(show_spinner=False)
+def _open_spreadsheet(sheet_id: str):
+    client, _ = get_client_and_sheet_id()
+    return sheets_call("read", client.open_by_key, sheet_id)
+
+@traced("get_spreadsheet")
+def get_spreadsheet():
+    try:
+        return _open_spreadsheet(spreadsheet_id())
+    except gse.APIError:
+        st.error("تعذّر فتح Google Sheet (قد تكون الكوتا تجاوزت الحد).")
+        raise
+
+BATCH_GET_CHUNK = 40  # عدد الأوراق في كل values_batch_get (طول الـURL محدود)
+CONCURRENT_READS = 4  # أقصى عدد طلبات batchGet في نفس الوقت
+
+def _a1_title(title: str) -> str:
+    return "'" + title.replace("'", "''") + "'"
+
+def _fill_gaps(rows: list[list[str]]) -> list[list[str]]:
+    # نفس الـpadding متاع ws.get_all_values(): batchGet يقصّ الخلايا الفارغة في آخر كل سطر
+    width = max((len(r) for r in rows), default=0)
+    return [r + [""]*(width-len(r)) for r in rows]
+
+def batch_get_values(sh, titles: list[str], rng: str = "", chunk: int = BATCH_GET_CHUNK) -> dict[str, list[list[str]]]:
+    background, api = in_background(), _api_counter()
+    def _get(part):
+        _call_ctx.background, _call_ctx.api = background, api  # workers متاع الـpool ياخذو نفس الأولوية والعدّاد
+        res = sheets_call("read", sh.values_batch_get, [_a1_title(t) + (f"!{rng}" if rng else "") for t in part])
+        return {t: _fill_gaps(vr.get("values", [])) for t, vr in zip(part, res.get("valueRanges", []))}
+    parts = [titles[i:i+chunk] for i in range(0, len(titles), chunk)]
+    if len(parts) <= 1:
+        return _get(parts[0]) if parts else {}
+    out = {}
+    with ThreadPoolExecutor(max_workers=min(CONCURRENT_READS, len(parts))) as pool:
+        for res in pool.map(_get, parts):
+            out.update(res)
+    return out
+
+# ============ Local Snapshots ============
+def _snapshot_path() -> str:
+    try:
+        return str(st.secrets.get("snapshot_db", ".megacrm_cache/snapshots.sqlite"))
+    except Exception:
+        return ".megacrm_cache/snapshots.sqlite"
+
+class SnapshotStore:
+    # نسخة محلية (SQLite) من كل ورقة: القراءة عند الإقلاع ما تستنّاش Google Sheets، وتخدم كي يطيح ولا تكمل الكوتا
+    def __init__(self, path: str, sheet_id: str):
+        self.sheet_id = sheet_id
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ws_rows (sheet_id TEXT, title TEXT, idx INTEGER, row TEXT, PRIMARY KEY (sheet_id, title, idx))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS ws_sync (sheet_id TEXT, title TEXT, synced_at REAL, PRIMARY KEY (sheet_id, title))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS kv (sheet_id TEXT, key TEXT, value TEXT, saved_at REAL, PRIMARY KEY (sheet_id, key))")
+
+    def load(self, title: str) -> tuple[list[list[str]], float]|None:
+        with self._lock:
+            sync = self._db.execute("SELECT synced_at FROM ws_sync WHERE sheet_id=? AND title=?", (self.sheet_id, title)).fetchone()
+            if sync is None:
+                return None
+            rows = self._db.execute("SELECT row FROM ws_rows WHERE sheet_id=? AND title=? ORDER BY idx", (self.sheet_id, title)).fetchall()
+        return [json.loads(r[0]) for r in rows], float(sync[0])
+
+    def save(self, title: str, values: list[list[str]], synced_at: float, start: int = 0):
+        # start>0: الأسطر [0:start] موجودة من قبل ونزيدو كان اللي بعدها
+        with self._lock, self._db:
+            if start <= 0:
+                self._db.execute("DELETE FROM ws_rows WHERE sheet_id=? AND title=?", (self.sheet_id, title))
+            self._db.executemany("INSERT OR REPLACE INTO ws_rows VALUES (?,?,?,?)",
+                                 [(self.sheet_id, title, i, json.dumps(r, ensure_ascii=False)) for i, r in enumerate(values[start:], start)])
+            self._db.execute("INSERT OR REPLACE INTO ws_sync VALUES (?,?,?)", (self.sheet_id, title, synced_at))
+
+    def drop(self, title: str):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM ws_rows WHERE sheet_id=? AND title=?", (self.sheet_id, title))
+            self._db.execute("DELETE FROM ws_sync WHERE sheet_id=? AND title=?", (self.sheet_id, title))
+
+    def get_kv(self, key: str) -> tuple[object, float]|None:
+        with self._lock:
+            r = self._db.execute("SELECT value, saved_at FROM kv WHERE sheet_id=? AND key=?", (self.sheet_id, key)).fetchone()
+        return (json.loads(r[0]), float(r[1])) if r else None
+
+    def set_kv(self, key: str, value, saved_at: float):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO kv VALUES (?,?,?,?)", (self.sheet_id, key, json.dumps(value, ensure_ascii=False), saved_at))
+
+@st.cache_resource(show_spinner=False)
+def snapshots() -> SnapshotStore:
+    return SnapshotStore(_snapshot_path(), spreadsheet_id())
+
+def fmt_age(seconds: float|None) -> str:
+    if seconds is None: return "—"
+    if seconds < 60: return "الآن"
+    if seconds < 3600: return f"منذ {int(seconds//60)} دقيقة"
+    if seconds < 86400: return f"منذ {int(seconds//3600)} ساعة"
+    return f"منذ {int(seconds//86400)} يوم"
+
+META_TTL = 600  # احتياط: أوراق تتزاد/تتبدّل من برّا التطبيق
+
+class SheetMeta:
+    # title -> {"props": خصائص الورقة (id/حجم), "header": السطر 1}، تتحمّل الكل بطلبين (metadata + batchGet)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tabs = None
+        self._loaded_at = 0.0
+        snap = snapshots().get_kv("sheet_meta")
+        if snap is not None:
+            self._tabs, self._loaded_at = snap
+
+    def refresh(self):
+        sh = get_spreadsheet()
+        meta = sheets_call("read", sh.fetch_sheet_metadata)
+        props = [s["properties"] for s in meta.get("sheets", [])
+                 if s["properties"].get("sheetType", "GRID") == "GRID"]
+        headers = batch_get_values(sh, [p["title"] for p in props], rng="1:1")
+        tabs = {p["title"]: {"props": p, "header": (headers.get(p["title"]) or [[]])[0]} for p in props}
+        self._set(tabs)
+        return tabs
+
+    def _set(self, tabs: dict):
+        now = time.time()
+        with self._lock:
+            self._tabs, self._loaded_at = tabs, now
+        snapshots().set_kv("sheet_meta", tabs, now)
+
+    def tabs(self) -> dict:
+        tabs = self._tabs
+        if tabs is None:
+            tabs = single_flight().do(("meta",), self.refresh)
+        elif time.time() - self._loaded_at > META_TTL:
+            run_in_background(("meta",), self.refresh)
+        return tabs
+
+    def age(self) -> float|None:
+        return time.time() - self._loaded_at if self._tabs is not None else None
+
+    def get(self, title: str) -> dict|None:
+        return self.tabs().get(title)
+
+    def titles(self) -> list[str]:
+        return list(self.tabs().keys())
+
+    def put(self, title: str, props: dict, header: list[str]):
+        tabs = dict(self._tabs or {})
+        tabs[title] = {"props": props, "header": list(header)}
+        self._set(tabs)
+
+@st.cache_resource(show_spinner=False)
+def sheet_meta() -> SheetMeta:
+    return SheetMeta()
+
+@traced("ensure_ws")
+def ensure_ws(title: str, columns: list[str]):
+    sh = get_spreadsheet()
+    meta = sheet_meta()
+    tab = meta.get(title)
+    if tab is None:
+        tab = meta.refresh().get(title)  # ربما تزادت من برّا من بعد آخر تحميل
+    if tab is None:
+        ws = sheets_call("write", sh.add_worksheet, title=title, rows="2000", cols=str(max(len(columns), 12)), idempotent=False)
+        sheets_call("write", ws.update, "1:1", [columns + [""]*10])
+        meta.put(title, {"sheetId": ws.id, "title": ws.title, "index": ws.index,
+                         "gridProperties": {"rowCount": ws.row_count, "columnCount": ws.col_count}}, columns)
+        return ws
+    ws = gspread.Worksheet(sh, tab["props"], sh.id, sh.client)
+    header = tab["header"]
+    if header[:len(columns)] != columns or len(header) != len(columns):
+        sheets_call("write", ws.update, "1:1", [columns + [""]*10])
+        meta.put(title, tab["props"], columns)
+        invalidate_ws(title)
+    return ws
+
+FIN_VALUES_TTL = 120
+CLIENTS_TTL = 600
+
+class ValuesCache:
+    # title -> {"values", "confirmed", "fetched_at", "version"} مشتركة بين الجلسات ومحفوظة في SnapshotStore.
+    # stale-while-revalidate: entry قديمة تتخدم فورًا وتتحدّث في الخلفية؛ كان أول تحميل (ما فماش حتى نسخة) يستنّى.
+    # values = الأسطر اللي في الورقة (confirmed) + الأسطر المعلّقة في WriteQueue (overlay، موش في الـsnapshot)
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._gen = {}      # يتزاد مع كل كتابة/إبطال: تحميل بدا قبلها ما يكتبش فوقها
+        self._errors = {}
+        self._loaders = {}  # title -> (loader, delta, ttl) باش الـrefresher ينجم يعاود يقرا
+        self._groups = {}   # group -> (titles, bulk_loader, ttl)
+        self._pending = {}  # title -> أسطر تسجّلت وما تكتبتش بعد في Sheets
+        self._seq = 0
+
+    def _entry(self, title: str) -> dict|None:
+        e = self._entries.get(title)
+        if e is None:
+            snap = snapshots().load(title)
+            if snap is not None:
+                with self._lock:
+                    e = self._entries.get(title)
+                    if e is None:
+                        e = self._entries[title] = self._new_entry(title, *snap)
+        return e
+
+    def _new_entry(self, title: str, values, fetched_at) -> dict:
+        self._seq += 1
+        pending = self._pending.get(title)
+        return {"values": values + pending if pending else values, "confirmed": len(values),
+                "fetched_at": fetched_at, "version": self._seq}
+
+    def _store(self, title: str, values: list[list[str]], gen: int, start: int = 0):
+        # الأسطر ما تبدّلتش (delta بلا جديد ولا تحميل كامل كيف كيف): نفس الـversion، الـmemos اللي فوقها ما تتعاودش
+        now = time.time()
+        with self._lock:
+            self._errors.pop(title, None)
+            if self._gen.get(title, 0) != gen:
+                return
+            old = self._entries.get(title)
+            same = old is not None and old["confirmed"] == len(values) and old["values"][:old["confirmed"]] == values
+            self._entries[title] = dict(old, fetched_at=now) if same else self._new_entry(title, values, now)
+        snapshots().save(title, values, now, len(values) if same else start)
+
+    def _fail(self, title: str, err: Exception):
+        with self._lock:
+            self._errors[title] = f"{type(err).__name__}: {err}"
+
+    def _refresh(self, title: str, e: dict|None, loader, delta, gen: int) -> list[list[str]]:
+        # delta(values_cached) -> values كاملة بعد إضافة الأسطر الجديدة، ولا None = لازم تحميل كامل
+        try:
+            if e is not None and delta is not None:
+                values = delta(e["values"][:e["confirmed"]])
+                if values is not None:
+                    self._store(title, values, gen, start=e["confirmed"])
+                    return self._entries[title]["values"] if title in self._entries else values
+            values = loader()
+        except Exception as err:
+            self._fail(title, err)
+            raise
+        self._store(title, values, gen)
+        return self._entries[title]["values"] if title in self._entries else values
+
+    def _bulk_job(self, part: list[str], bulk_loader, gens: dict|None = None):
+        gens = gens or {t: self._gen.get(t, 0) for t in part}
+        def _run():
+            try:
+                loaded = bulk_loader(part)
+            except Exception as err:
+                for t in part:
+                    self._fail(t, err)
+                raise
+            for t in part:
+                self._store(t, loaded.get(t, []), gens[t])
+            return {t: self._entries[t]["values"] if t in self._entries else loaded.get(t, []) for t in part}
+        return _run
+
+    def _stale_job(self, stale: dict[str, dict], bulk_loader, bulk_delta=None):
+        # bulk_delta({title: values_cached}) -> {title: values كاملة ولا None}: الأوراق القديمة تتزامن بـdelta
+        # في batch واحد، واللي رجعت None (تبدّلت من برّا) برك تتحمّل كاملة
+        if bulk_delta is None:
+            return self._bulk_job(list(stale), bulk_loader)
+        gens = {t: self._gen.get(t, 0) for t in stale}
+        def _run():
+            try:
+                res = bulk_delta({t: e["values"][:e["confirmed"]] for t, e in stale.items()})
+            except Exception as err:
+                for t in stale:
+                    self._fail(t, err)
+                raise
+            out, full = {}, []
+            for t, e in stale.items():
+                values = res.get(t)
+                if values is None:
+                    full.append(t)
+                    continue
+                self._store(t, values, gens[t], start=e["confirmed"])
+                out[t] = self._entries[t]["values"] if t in self._entries else values
+            if full:
+                out.update(self._bulk_job(full, bulk_loader, {t: gens[t] for t in full})())
+            return out
+        return _run
+
+    def _due(self, e: dict, ttl: float, margin: float = 0.0) -> bool:
+        return time.time() - e["fetched_at"] > ttl - margin
+
+    def get(self, title: str, loader, delta=None, ttl: float|None = None) -> list[list[str]]:
+        ttl = self.ttl if ttl is None else ttl
+        self._loaders[title] = (loader, delta, ttl)
+        e = self._entry(title)
+        gen = self._gen.get(title, 0)
+        if e is not None:
+            stale = self._due(e, ttl)
+            perf_note(cache="stale" if stale else "hit")
+            if stale:
+                run_in_background(("values", title), lambda: self._refresh(title, e, loader, delta, gen))
+            return e["values"]
+        perf_note(cache="miss")
+        return single_flight().do(("values", title), lambda: self._refresh(title, None, loader, delta, gen))
+
+    def get_many(self, titles: list[str], bulk_loader, ttl: float|None = None, group: str|None = None,
+                 bulk_delta=None) -> dict[str, list[list[str]]]:
+        # نفس get لكن الأوراق الناقصة تتجاب مع بعضها بطلب batch واحد، والقديمة بـbulk_delta (كان موجود)
+        ttl = self.ttl if ttl is None else ttl
+        if group:
+            self._groups[group] = (list(titles), bulk_loader, ttl, bulk_delta)
+        out, missing, stale = {}, [], {}
+        for t in titles:
+            e = self._entry(t)
+            if e is None:
+                missing.append(t)
+                continue
+            out[t] = e["values"]
+            if self._due(e, ttl):
+                stale[t] = e
+        perf_note(cache="miss" if missing else ("stale" if stale else "hit"), sheets=len(titles),
+                  missing=len(missing), stale=len(stale))
+        if stale:
+            run_in_background(("values_many", tuple(stale)), self._stale_job(stale, bulk_loader, bulk_delta))
+        if missing:
+            out.update(single_flight().do(("values_many", tuple(missing)), self._bulk_job(missing, bulk_loader)))
+        return out
+
+    def confirmed_many(self, titles: list[str], bulk_loader, ttl: float, bulk_delta=None) -> dict[str, list[list[str]]]:
+        # للقراءات اللي لازمها الورقة كيف ما هي (export): اللي فات الـTTL متاعو يتزامن توّا (موش في الخلفية)،
+        # ونرجعو كان الأسطر اللي في Sheets (من غير المعلّقة). الأوراق اللي موش في الكاش ما ترجعش
+        entries = {t: e for t in titles if (e := self._entry(t)) is not None}
+        stale = {t: e for t, e in entries.items() if self._due(e, ttl)}
+        if stale:
+            single_flight().do(("values_many", tuple(stale)), self._stale_job(stale, bulk_loader, bulk_delta))
+        entries.update({t: self._entries[t] for t in stale if t in self._entries})
+        return {t: e["values"][:e["confirmed"]] for t, e in entries.items()}
+
+    def refresh_if_due(self, title: str, margin: float) -> bool:
+        # للـrefresher: نعاود نقراو entry موجودة قبل ما يوفى الـTTL متاعها
+        reg, e = self._loaders.get(title), self._entries.get(title)
+        if reg is None or e is None or not self._due(e, reg[2], margin):
+            return False
+        loader, delta, _ = reg
+        gen = self._gen.get(title, 0)
+        single_flight().do(("values", title), lambda: self._refresh(title, e, loader, delta, gen))
+        return True
+
+    def refresh_group_if_due(self, group: str, margin: float) -> bool:
+        reg = self._groups.get(group)
+        if reg is None:
+            return False
+        titles, bulk_loader, ttl, bulk_delta = reg
+        missing = [t for t in titles if t not in self._entries]
+        stale = {t: e for t in titles if (e := self._entries.get(t)) is not None and self._due(e, ttl, margin)}
+        if not missing and not stale:
+            return False
+        if stale:
+            single_flight().do(("values_many", tuple(stale)), self._stale_job(stale, bulk_loader, bulk_delta))
+        if missing:
+            single_flight().do(("values_many", tuple(missing)), self._bulk_job(missing, bulk_loader))
+        return True
+
+    def invalidate(self, title: str):
+        with self._lock:
+            self._entries.pop(title, None)
+            self._gen[title] = self._gen.get(title, 0) + 1
+        snapshots().drop(title)
+
+    def _rebuild(self, title: str, e: dict, confirmed: list[list[str]]):
+        # lock لازم يكون مشدود
+        self._seq += 1
+        pending = self._pending.get(title) or []
+        self._entries[title] = dict(e, values=confirmed + pending, confirmed=len(confirmed), version=self._seq)
+
+    def add_pending(self, title: str, rows: list[list[str]]):
+        # optimistic: السطر يبان فورًا في القراءات (جداول، ملخّصات، دفعات سابقة) قبل ما يتكتب
+        with self._lock:
+            self._pending.setdefault(title, []).extend(rows)
+            e = self._entries.get(title)
+            if e is not None:
+                self._rebuild(title, e, e["values"][:e["confirmed"]])
+
+    def _take_pending(self, title: str, rows: list[list[str]]):
+        ids = {id(r) for r in rows}
+        left = [r for r in self._pending.get(title, []) if id(r) not in ids]
+        if left:
+            self._pending[title] = left
+        else:
+            self._pending.pop(title, None)
+
+    def drop_pending(self, title: str, rows: list[list[str]]):
+        # الكتابة فشلت: الأسطر تتنحّى من الـoverlay (WriteQueue يخلّيهم failed)
+        with self._lock:
+            self._take_pending(title, rows)
+            e = self._entries.get(title)
+            if e is not None:
+                self._rebuild(title, e, e["values"][:e["confirmed"]])
+
+    def confirm_pending(self, title: str, rows: list[list[str]], start_row: int|None):
+        # write-through: الأسطر تكتبت في الورقة. لو نزلو مباشرة بعد آخر سطر معروف يوليو confirmed
+        # (صفر قراءة)، وإلا (الورقة تبدّلت من برّا) نعاودو نقراو
+        with self._lock:
+            self._take_pending(title, rows)
+            self._gen[title] = self._gen.get(title, 0) + 1
+            e = self._entries.get(title)
+            if e is None:
+                return
+            n = e["confirmed"]
+            if start_row is not None and start_row != n + 1:
+                self._entries.pop(title, None)
+                landed = None
+            else:
+                width = len(e["values"][0]) if e["values"] else 0
+                landed = e["values"][:n] + [r if len(r) >= width else list(r) + [""]*(width-len(r)) for r in rows]
+                self._rebuild(title, e, landed)
+        if landed is None:
+            snapshots().drop(title)
+        else:
+            snapshots().save(title, landed, e["fetched_at"], start=n)
+
+    def peek(self, title: str) -> list[list[str]]|None:
+        e = self._entries.get(title)
+        return e["values"] if e is not None else None
+
+    def row_count(self, title: str) -> int|None:
+        e = self._entries.get(title)
+        return e["confirmed"] if e is not None else None
+
+    def pending_count(self, title: str) -> int:
+        return len(self._pending.get(title) or [])
+
+    def versions(self, titles: list[str]) -> tuple:
+        return tuple((self._entries.get(t) or {}).get("version") for t in titles)
+
+    def age(self, title: str) -> float|None:
+        e = self._entries.get(title)
+        return time.time() - e["fetched_at"] if e is not None else None
+
+    def last_error(self, title: str) -> str|None:
+        return self._errors.get(title)
+
+@st.cache_resource(show_spinner=False)
+def values_cache() -> ValuesCache:
+    return ValuesCache(FIN_VALUES_TTL)
+
+def is_fin_title(title: str) -> bool:
+    return title.startswith("Revenue ") or title.startswith("Dépense ")
+
+def _col_letter(n: int) -> str:
+    s = ""
+    while n > 0:
+        n, r = divmod(n-1, 26)
+        s = chr(65+r) + s
+    return s
+
+def _rstrip_row(r: list[str]) -> list[str]:
+    r = list(r)
+    while r and r[-1] == "":
+        r.pop()
+    return r
+
+def _delta_ranges(title: str, cached: list[list[str]]) -> list[str]:
+    a1 = _a1_title(title)
+    return [f"{a1}!1:1", f"{a1}!A{len(cached)}:{_col_letter(len(cached[0]))}"]
+
+def fin_delta_sync(title: str, cached: list[list[str]]) -> list[list[str]]|None:
+    # أوراق Revenue/Dépense تكبر كان بـappend: نجيبو السطر 1 + من آخر سطر معروف للآخر في طلب واحد.
+    # لو الـheader تبدّل ولا آخر سطر معروف ما عادش كيف ما هو (تعديل/حذف) -> None = تحميل كامل.
+    if len(cached) < 2:
+        return None
+    res = sheets_call("read", get_spreadsheet().values_batch_get, _delta_ranges(title, cached))
+    return _apply_delta(cached, res.get("valueRanges", []))
+
+def fin_delta_sync_many(cached: dict[str, list[list[str]]]) -> dict[str, list[list[str]]|None]:
+    # نفس fin_delta_sync لبرشا أوراق: رانجين لكل ورقة، BATCH_GET_CHUNK رانج في كل batchGet
+    todo = [t for t, c in cached.items() if len(c) >= 2]
+    out = {t: None for t in cached}
+    step = max(BATCH_GET_CHUNK // 2, 1)
+    for i in range(0, len(todo), step):
+        part = todo[i:i+step]
+        res = sheets_call("read", get_spreadsheet().values_batch_get,
+                          [r for t in part for r in _delta_ranges(t, cached[t])])
+        ranges = res.get("valueRanges", [])
+        for k, t in enumerate(part):
+            out[t] = _apply_delta(cached[t], ranges[2*k:2*k+2])
+    return out
+
+def _apply_delta(cached: list[list[str]], ranges: list[dict]) -> list[list[str]]|None:
+    if len(ranges) != 2:
+        return None
+    width = len(cached[0])
+    head, tail = ranges[0].get("values", []), ranges[1].get("values", [])
+    if not head or _rstrip_row(head[0]) != _rstrip_row(cached[0]):
+        return None
+    if not tail or _rstrip_row(tail[0]) != _rstrip_row(cached[-1]):
+        return None
+    new_rows = tail[1:]
+    if not new_rows:
+        return cached
+    if any(len(r) > width for r in new_rows):
+        return None
+    return cached + [list(r) + [""]*(width-len(r)) for r in new_rows]
+
+@traced("read_values")
+def _read_ws_all_values_cached(title: str, cols: tuple) -> list[list[str]]:
+    delta = (lambda cached: fin_delta_sync(title, cached)) if is_fin_title(title) else None
+    return values_cache().get(title, lambda: sheets_call("read", ensure_ws(title, list(cols)).get_all_values), delta)
+
+def invalidate_ws(title: str):
+    values_cache().invalidate(title)
+
+@traced("fin_read_df")
+def fin_read_df(title: str, kind: str) -> pd.DataFrame:
+    # الإطار المحوّل مشترك بين الجلسات: للقراءة فقط
+    expected = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
+    return typed_frames().get(title, kind, _read_ws_all_values_cached(title, tuple(expected)))
+
+def _parse_dates(s: pd.Series) -> pd.Series:
+    # الصيغ الصريحة (سريعة) الأولى، ISO (2026-03-05 10:30) من غير ما نقلبو النهار والشهر،
+    # وبعدها اللي بقى (05-03-2026، 05.03.2026، مع الوقت...) بـdayfirst كيف قبل
+    d = pd.to_datetime(s, format="%d/%m/%Y", errors="coerce")
+    for fmt in ("%Y-%m-%d", "ISO8601", None):
+        rest = d.isna() & (s.str.strip() != "")
+        if not rest.any():
+            break
+        if fmt is None:
+            d[rest] = pd.to_datetime(s[rest], format="mixed", dayfirst=True, errors="coerce")
+        else:
+            d[rest] = pd.to_datetime(s[rest], format=fmt, errors="coerce")
+    return d
+
+def _parse_amounts(s: pd.Series) -> pd.Series:
+    # "1 200,50" -> 1200.5؛ النص اللي موش رقم -> NaN
+    return pd.to_numeric(s.str.replace(" ","",regex=False).str.replace(",",".",regex=False), errors="coerce")
+
+def fin_parse_values(values: list[list[str]], kind: str) -> pd.DataFrame:
+    # تحويل واحد vectorized من القيم الخام للأنواع النهائية: كل المبالغ مع بعضها، كل التواريخ مع بعضها
+    expected = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
+    if not values:
+        return pd.DataFrame(columns=expected)
+    header, rows = values[0], values[1:]
+    n = len(rows)
+    pos = {}
+    for i, h in enumerate(header):
+        pos.setdefault(h, i)  # أعمدة مكرّرة: ناخذو الأولى
+    by_col = list(zip(*rows)) if rows else []
+    def raw(col):
+        i = pos.get(col)
+        return np.asarray(by_col[i] if i is not None and i < len(by_col) else [""]*n, dtype=object)
+
+    data = {}
+    amounts = [c for c in expected if c in FIN_AMOUNT_COLS]
+    nums = _parse_amounts(pd.Series(np.concatenate([raw(c) for c in amounts]), dtype=object)).fillna(0.0).to_numpy("float64")
+    for k, c in enumerate(amounts):
+        data[c] = nums[k*n:(k+1)*n]
+    dates = [c for c in expected if c in FIN_DATE_COLS and (c != "Echeance" or kind == "Revenus")]
+    flat = _parse_dates(pd.Series(np.concatenate([raw(c) for c in dates]), dtype=object))
+    for k, c in enumerate(dates):
+        data[c] = flat.iloc[k*n:(k+1)*n].to_numpy()
+    for c in expected:
+        if c in data:
+            continue
+        data[c] = pd.Categorical(raw(c)) if c in FIN_CATEGORY_COLS else raw(c)
+    df = pd.DataFrame(data, columns=expected)
+    if kind == "Revenus":
+        today_ts = pd.Timestamp.now().normalize()
+        ech, due = df["Echeance"], df["Reste"] > 0
+        alert = np.where(ech.notna() & (ech < today_ts) & due, "⚠️ متأخر", "")
+        alert = np.where(ech.notna() & (ech.dt.normalize() == today_ts) & due, "⏰ اليوم", alert)
+        df["Alert"] = pd.Categorical(alert)
+    return df
+
+def _concat_typed(a: pd.DataFrame, b: pd.DataFrame) -> pd.DataFrame:
+    out = pd.concat([a, b], ignore_index=True)
+    for c in FIN_CATEGORY_COLS:
+        if c in a.columns and c in b.columns:
+            out[c] = union_categoricals([a[c], b[c]])
+    return out
+
+FIN_SEARCH_COLS = ["Libellé","Catégorie","Mode","Employé","Note","Caisse_Source","Montant_PreInscription"]
+_SEARCH_MARKS_RE = "[\u0300-\u036f\u064b-\u065f\u0670]"  # accents لاتينية + تشكيل عربي
+
+def normalize_search_text(s: pd.Series) -> pd.Series:
+    # lowercase، بلا accents (é -> e) وبلا تشكيل، وفراغات موحّدة
+    return (s.str.normalize("NFKD").str.replace(_SEARCH_MARKS_RE, "", regex=True)
+             .str.lower().str.replace(r"\s+", " ", regex=True))
+
+def fin_search_text(df: pd.DataFrame) -> pd.Series:
+    # نص واحد لكل سطر (أعمدة البحث ملصوقة) مطبّع مرّة وحدة -> البحث = str.contains على عمود واحد
+    parts = []
+    for c in [c for c in FIN_SEARCH_COLS if c in df.columns]:
+        col = df[c]
+        parts.append(pd.Series(np.char.mod("%.2f", col.to_numpy("float64")), index=df.index) if c in FIN_AMOUNT_COLS
+                     else col.astype(str))
+    if not parts:
+        return pd.Series("", index=df.index)
+    return normalize_search_text(parts[0].str.cat(parts[1:], sep=" | "))
+
+def search_mask(hay: pd.Series, query: str) -> pd.Series:
+    # كل كلمة في البحث لازم تكون موجودة (AND)؛ الـmask على نفس index متاع hay
+    m = pd.Series(True, index=hay.index)
+    for term in normalize_search_text(pd.Series([query])).iloc[0].split():
+        m &= hay.str.contains(term, regex=False)
+    return m
+
+def _norm_equals(s: pd.Series, value: str) -> np.ndarray:
+    # مقارنة بعد strip/lower؛ للـcategorical تتحسب على الـcategories برك
+    value = value.strip().lower()
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cats = pd.Series(s.cat.categories, dtype=str).str.strip().str.lower().to_numpy()
+        return np.isin(s.cat.codes.to_numpy(), np.flatnonzero(cats == value))
+    return (s.fillna("").astype(str).str.strip().str.lower() == value).to_numpy()
+
+def fin_view_rows(title: str, df: pd.DataFrame, employee: str = "", date_from=None, date_to=None,
+                  search: str = "") -> np.ndarray:
+    # فلترة الجلسة فوق الإطار المشترك (ما يتنسخش وما يتبدّلش): ترجع أرقام الأسطر برك،
+    # والعرض ياخذ df.iloc[rows] للأعمدة المعروضة
+    keep = np.ones(len(df), dtype=bool)
+    if employee and "Employé" in df.columns:
+        keep &= _norm_equals(df["Employé"], employee)
+    if "Date" in df.columns:
+        if date_from: keep &= (df["Date"] >= pd.to_datetime(date_from)).to_numpy()
+        if date_to:   keep &= (df["Date"] <= pd.to_datetime(date_to)).to_numpy()
+    if search and keep.any():
+        rows = np.flatnonzero(keep)
+        hay = typed_frames().search_text(title, df)
+        keep[rows] = search_mask(hay.iloc[rows], search).to_numpy()
+    return np.flatnonzero(keep)
+
+class TypedFrames:
+    # title -> الإطار المحوّل + مرجع القيم الخام اللي تحوّل منها. القيم ما تبدّلتش = نفس الإطار؛
+    # تزادو أسطر في الآخر (write-through/delta) = نحوّلو كان الجداد ونلصقوهم (ونفس الشي لنص البحث)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frames = {}
+
+    def get(self, title: str, kind: str, values: list[list[str]]) -> pd.DataFrame:
+        today = date.today()
+        e = self._frames.get(title)
+        if e is not None and e["kind"] == kind and e["day"] == today:
+            old = e["values"]
+            if old is values:
+                return e["df"]
+            k = len(old)
+            if 1 < k <= len(values) and values[k-1] is old[-1] and values[0] is old[0]:
+                if k == len(values):
+                    return self._put(title, kind, today, values, e["df"], e["hay"])  # نفس الأسطر في list جديدة
+                new = fin_parse_values([values[0]] + values[k:], kind)
+                hay = e["hay"]
+                if hay is not None:
+                    hay = pd.concat([hay, fin_search_text(new)], ignore_index=True)
+                return self._put(title, kind, today, values, _concat_typed(e["df"], new), hay)
+        return self._put(title, kind, today, values, fin_parse_values(values, kind))
+
+    def _put(self, title, kind, day, values, df, hay=None) -> pd.DataFrame:
+        with self._lock:
+            self._frames[title] = {"kind": kind, "day": day, "values": values, "df": df, "hay": hay}
+        return df
+
+    def search_text(self, title: str, df: pd.DataFrame) -> pd.Series:
+        # نص البحث متاع الإطار المشترك: يتحسب أوّل مرّة يتطلب، ومن بعد يكبر مع الإطار
+        e = self._frames.get(title)
+        if e is None or e["df"] is not df:
+            return fin_search_text(df)
+        if e["hay"] is None:
+            e["hay"] = fin_search_text(df)
+        return e["hay"]
+
+@st.cache_resource(show_spinner=False)
+def typed_frames() -> TypedFrames:
+    return TypedFrames()
+
+def _appended_start_row(resp) -> int|None:
+    rng = ((resp or {}).get("updates") or {}).get("updatedRange", "")
+    m = re.search(r"![A-Z]+(\d+)", rng)
+    return int(m.group(1)) if m else None
+
+# ============ Write Queue ============
+WRITE_FLUSH_DELAY = 1.5   # ثواني: الحفظات المتتالية على نفس الورقة يتجمّعو في append_rows واحد
+WRITE_DONE_KEEP   = 60    # قدّاش تقعد العملية المكتوبة ظاهرة في الحالة
+
+class WriteQueue:
+    # الحفظ = سطر في الطابور + overlay فوري في الكاش (optimistic)، وthread واحد يفرّغ الطابور:
+    # كل الأسطر المعلّقة لنفس الورقة تتكتب بطلب append_rows واحد.
+    # op: {"id","title","kind","row","owner","status": pending|writing|done|failed,"error","at"}
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._ops = {}
+        self._queue = {}  # title -> [op_id] بالترتيب
+        self._seq = 0
+        self._thread = threading.Thread(target=self._loop, name="megacrm-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)  # إيقاف السيرفر ما يضيّعش الأسطر المعلّقة
+
+    def _loop(self):
+        while True:
+            self._wake.wait()
+            time.sleep(WRITE_FLUSH_DELAY)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # الـops تبقى بحالتها والـthread ما يموتش
+
+    def _enqueue(self, ops: list[dict]):
+        with self._lock:
+            for op in ops:
+                op.update(status="pending", error=None, at=time.time())
+                self._ops[op["id"]] = op
+                self._queue.setdefault(op["title"], []).append(op["id"])
+        by_title = {}  # retry يجيب Revenus و Dépenses مع بعضهم: كل ورقة بالـkind متاعها
+        for op in ops:
+            by_title.setdefault(op["title"], (op["kind"], []))[1].append(op["row"])
+        for title, (kind, rows) in by_title.items():
+            values_cache().add_pending(title, rows)
+            _sync_fin_indexes(title, kind)
+        self._wake.set()
+
+    def submit(self, title: str, row: dict, kind: str, owner: str = "") -> str:
+        return self.submit_many(title, [row], kind, owner)[0]
+
+    def submit_many(self, title: str, rows: list[dict], kind: str, owner: str = "") -> list[str]:
+        cols = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
+        with self._lock:
+            first = self._seq + 1
+            self._seq += len(rows)
+        ops = [{"id": f"w{first+i}", "title": title, "kind": kind, "owner": owner,
+                "row": [str(row.get(col, "")) for col in cols]} for i, row in enumerate(rows)]
+        self._enqueue(ops)
+        return [op["id"] for op in ops]
+
+    def retry(self, op_ids: list[str]):
+        with self._lock:
+            ops = [self._ops[i] for i in op_ids if i in self._ops and self._ops[i]["status"] == "failed"]
+        if ops:
+            self._enqueue(ops)
+
+    def discard(self, op_ids: list[str]):
+        with self._lock:
+            for i in op_ids:
+                if i in self._ops and self._ops[i]["status"] == "failed":
+                    del self._ops[i]
+
+    def flush(self):
+        with self._lock:
+            batches = {t: [self._ops[i] for i in ids] for t, ids in self._queue.items() if ids}
+            self._queue = {}
+            for ops in batches.values():
+                for op in ops:
+                    op["status"] = "writing"
+        for title, ops in batches.items():
+            self._flush_title(title, ops)
+
+    def _flush_title(self, title: str, ops: list[dict]):
+        kind = ops[0]["kind"]
+        rows = [op["row"] for op in ops]
+        cache = values_cache()
+        with perf_span("flush_writes", title=title, rows=len(rows)) as rec:
+            try:
+                ws = ensure_ws(title, FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS)
+                resp = sheets_call("write", ws.append_rows, rows, idempotent=False)
+            except Exception as e:
+                rec["error"] = type(e).__name__
+                cache.drop_pending(title, rows)
+                self._finish(ops, "failed", f"{type(e).__name__}: {e}")
+            else:
+                cache.confirm_pending(title, rows, _appended_start_row(resp))
+                self._finish(ops, "done")
+            _sync_fin_indexes(title, kind)
+
+    def _finish(self, ops: list[dict], status: str, error: str|None = None):
+        now = time.time()
+        with self._lock:
+            for op in ops:
+                op.update(status=status, error=error, at=now)
+            for i in [i for i, op in self._ops.items() if op["status"] == "done" and now - op["at"] > WRITE_DONE_KEEP]:
+                del self._ops[i]
+
+    def status(self, owner: str|None = None) -> list[dict]:
+        with self._lock:
+            return [dict(op) for op in self._ops.values() if owner is None or op["owner"] == owner]
+
+@st.cache_resource(show_spinner=False)
+def write_queue() -> WriteQueue:
+    return WriteQueue()
+
+def _sync_fin_indexes(title: str, kind: str):
+    if kind == "Revenus":
+        payment_ledger().sync(title)
+    fin_aggregates().sync(title, kind)
+
+@traced("fin_append_row")
+def fin_append_row(title: str, row: dict, kind: str, owner: str = "") -> str:
+    # ترجع فورًا: السطر يبان في القراءات توّا ويتكتب في Sheets مع اللي بعدو (WriteQueue)
+    return write_queue().submit(title, row, kind, owner)
+
+def fin_values_many(titles: list[str]) -> dict[str, list[list[str]]]:
+    # أوراق مالية برشا مع بعضها: اللي موش في الكاش تتجاب بطلب batch واحد
+    return values_cache().get_many(titles, lambda ts: batch_get_values(get_spreadsheet(), ts), ttl=FIN_VALUES_TTL,
+                                   bulk_delta=fin_delta_sync_many)
+
+# ============ Finance Aggregates ============
+# caisse -> (مفتاح المداخيل في Revenue, Caisse_Source في Dépense)
+FIN_CAISSES = {"Admin": ("Admin", "Caisse_Admin"), "Structure": ("Structure", "Caisse_Structure"),
+               "Inscription": ("Inscription", "Caisse_Inscription")}
+_REV_TOTAL_COLS = {"Admin": "Montant_Admin", "Structure": "Montant_Structure", "Inscription": "Montant_PreInscription",
+                   "Total": "Montant_Total", "Reste": "Reste"}
+_DAY_KEYS = ["Rev_Admin", "Rev_Structure", "Dep_Admin", "Dep_Structure"]
+
+class FinAggregates:
+    # لكل ورقة مالية: مجاميع الشهر (لكل caisse) والمجاميع اليومية. تتحسب مرّة من الإطار المحوّل،
+    # ومن بعد تتزاد كان الأسطر الجديدة (fin_append_row / delta sync) — الملخّصات ما تمسّش الأسطر
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._aggs = {}
+
+    def _fold(self, agg: dict, df: pd.DataFrame, kind: str) -> dict:
+        totals, by_day = dict(agg["totals"]), dict(agg["by_day"])
+        def _add_day(day_sums: pd.Series, key: str):
+            for d, v in day_sums.items():
+                slot = by_day[d] = dict(by_day.get(d) or dict.fromkeys(_DAY_KEYS, 0.0))
+                slot[key] += float(v)
+        if df.empty:
+            return {"totals": totals, "by_day": by_day}
+        days = df["Date"].dt.normalize()
+        if kind == "Revenus":
+            for k, c in _REV_TOTAL_COLS.items():
+                totals[k] = totals.get(k, 0.0) + float(df[c].sum())
+            _add_day(df["Montant_Admin"].groupby(days).sum(), "Rev_Admin")
+            _add_day(df["Montant_Structure"].groupby(days).sum(), "Rev_Structure")
+        else:
+            for caisse, v in df["Montant"].groupby(df["Caisse_Source"], observed=True).sum().items():
+                totals[caisse] = totals.get(caisse, 0.0) + float(v)
+            for caisse, key in (("Caisse_Admin", "Dep_Admin"), ("Caisse_Structure", "Dep_Structure")):
+                m = df["Caisse_Source"] == caisse
+                _add_day(df["Montant"][m].groupby(days[m]).sum(), key)
+        return {"totals": totals, "by_day": by_day}
+
+    def get(self, title: str, kind: str) -> dict:
+        expected = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
+        values = _read_ws_all_values_cached(title, tuple(expected))
+        e = self._aggs.get(title)
+        if e is not None and e["kind"] == kind and e["values"] is values:
+            return e
+        df = typed_frames().get(title, kind, values)
+        if e is not None and e["kind"] == kind and 1 < len(e["values"]) <= len(values) and values[len(e["values"])-1] is e["values"][-1]:
+            agg = self._fold(e, df.iloc[len(e["values"])-1:], kind)
+        else:
+            agg = self._fold({"totals": {}, "by_day": {}}, df, kind)
+        e = dict(agg, kind=kind, values=values)
+        with self._lock:
+            self._aggs[title] = e
+        return e
+
+    def sync(self, title: str, kind: str):
+        if values_cache().peek(title) is not None:
+            self.get(title, kind)
+
+@st.cache_resource(show_spinner=False)
+def fin_aggregates() -> FinAggregates:
+    return FinAggregates()
+
+@traced("monthly_summary")
+def monthly_summary(branch: str, mois: str) -> dict:
+    rev = fin_aggregates().get(fin_month_title(mois, "Revenus", branch), "Revenus")["totals"]
+    dep = fin_aggregates().get(fin_month_title(mois, "Dépenses", branch), "Dépenses")["totals"]
+    caisses = {}
+    for name, (rev_key, dep_key) in FIN_CAISSES.items():
+        r, d = rev.get(rev_key, 0.0), dep.get(dep_key, 0.0)
+        caisses[name] = {"rev": r, "dep": d, "reste": r - d}
+    return {"caisses": caisses,
+            "total_as": rev.get("Total", 0.0),
+            "reste_due": rev.get("Reste", 0.0),
+            "dep_total": sum(c["dep"] for c in caisses.values())}
+
+@traced("daily_summary")
+def daily_summary(branch: str, mois: str) -> pd.DataFrame:
+    rev = fin_aggregates().get(fin_month_title(mois, "Revenus", branch), "Revenus")["by_day"]
+    dep = fin_aggregates().get(fin_month_title(mois, "Dépenses", branch), "Dépenses")["by_day"]
+    start = pd.Timestamp(datetime.now().year, FIN_MONTHS_FR.index(mois) + 1, 1)
+    full_range = pd.date_range(start, start + pd.offsets.MonthEnd(1), freq="D")
+    zero = dict.fromkeys(_DAY_KEYS, 0.0)
+    daily = pd.DataFrame({
+        "Rev_Admin":     [(rev.get(d) or zero)["Rev_Admin"] for d in full_range],
+        "Rev_Structure": [(rev.get(d) or zero)["Rev_Structure"] for d in full_range],
+        "Dep_Admin":     [(dep.get(d) or zero)["Dep_Admin"] for d in full_range],
+        "Dep_Structure": [(dep.get(d) or zero)["Dep_Structure"] for d in full_range],
+    }, index=full_range)
+    daily["Reste_Admin_Journalier"]     = daily["Rev_Admin"]     - daily["Dep_Admin"]
+    daily["Reste_Structure_Journalier"] = daily["Rev_Structure"] - daily["Dep_Structure"]
+    daily["Reste_Admin_Cumulé"]     = daily["Reste_Admin_Journalier"].cumsum()
+    daily["Reste_Structure_Cumulé"] = daily["Reste_Structure_Journalier"].cumsum()
+    daily = daily.reset_index().rename(columns={"index":"Date"})
+    return daily[["Date","Rev_Admin","Dep_Admin","Reste_Admin_Journalier","Reste_Admin_Cumulé",
+                  "Rev_Structure","Dep_Structure","Reste_Structure_Journalier","Reste_Structure_Cumulé"]]
+
+# ============ Consolidation (all branches / months) ============
+def consolidate_fin(kind: str, branches: list[str] = FIN_BRANCHES, months: list[str] = FIN_MONTHS_FR) -> pd.DataFrame:
+    # كل أوراق النوع (فروع × أشهر) في إطار محوّل واحد مع Branche/Mois. الناقص من الكاش يتجاب بطلبات batch
+    # (CONCURRENT_READS في نفس الوقت)، والأشهر اللي ما عندهاش ورقة ما تتخلقش
+    expected = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
+    available = set(sheet_meta().titles())
+    wanted = [(b, m, fin_month_title(m, kind, b)) for b in branches for m in months]
+    wanted = [w for w in wanted if w[2] in available]
+    values = fin_values_many([t for _, _, t in wanted])
+    frames = []
+    for b, m, t in wanted:
+        df = typed_frames().get(t, kind, values.get(t) or [])
+        if not df.empty:
+            frames.append(df.assign(Branche=b, Mois=m))
+    if not frames:
+        return pd.DataFrame(columns=expected + ["Branche", "Mois"])
+    out = pd.concat(frames, ignore_index=True)
+    for c in FIN_CATEGORY_COLS:
+        if c in out.columns and all(c in f.columns for f in frames):
+            out[c] = union_categoricals([f[c] for f in frames])
+    out["Branche"] = pd.Categorical(out["Branche"], categories=branches)
+    out["Mois"] = pd.Categorical(out["Mois"], categories=months, ordered=True)
+    return out
+
+@traced("year_summary")
+def year_summary(branches: list[str] = FIN_BRANCHES, months: list[str] = FIN_MONTHS_FR) -> pd.DataFrame:
+    # سطر لكل (فرع، شهر): مداخيل/مصاريف/Reste لكل caisse، من FinAggregates (بعد قراءة batch للناقص)
+    available = set(sheet_meta().titles())
+    titles = [fin_month_title(m, k, b) for b in branches for m in months for k in ("Revenus", "Dépenses")]
+    fin_values_many([t for t in titles if t in available])
+    rows = []
+    for b in branches:
+        for m in months:
+            row = {"Branche": b, "Mois": m}
+            rev_t, dep_t = fin_month_title(m, "Revenus", b), fin_month_title(m, "Dépenses", b)
+            rev = fin_aggregates().get(rev_t, "Revenus")["totals"] if rev_t in available else {}
+            dep = fin_aggregates().get(dep_t, "Dépenses")["totals"] if dep_t in available else {}
+            for name, (rev_key, dep_key) in FIN_CAISSES.items():
+                row[f"Rev_{name}"] = rev.get(rev_key, 0.0)
+                row[f"Dep_{name}"] = dep.get(dep_key, 0.0)
+                row[f"Reste_{name}"] = row[f"Rev_{name}"] - row[f"Dep_{name}"]
+            row["Total_Admin_Structure"] = rev.get("Total", 0.0)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+# ============ Export ============
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_CHUNK_TABS = 6          # أوراق في كل batchGet: الذاكرة = chunk واحد مش العام الكل
+EXPORT_XLSX_MAX_ROWS = 1_000_000  # حد Excel (1,048,576): ورقة جديدة كي نوصلو
+EXPORT_COLUMNS = ["Branche","Mois","Type"] + list(dict.fromkeys(FIN_REV_COLUMNS + FIN_DEP_COLUMNS))
+
+def _export_frame(df: pd.DataFrame, branch: str, mois: str, kind: str) -> pd.DataFrame:
+    # أعمدة وأنواع ثابتة لكل الأوراق (Revenus و Dépenses في نفس الملف): مبالغ float، تواريخ datetime، والباقي نص
+    n, out = len(df), {"Branche": branch, "Mois": mois, "Type": kind}
+    for c in EXPORT_COLUMNS[3:]:
+        if c in FIN_AMOUNT_COLS:
+            out[c] = df[c].to_numpy("float64") if c in df.columns else np.full(n, np.nan)
+        elif c in FIN_DATE_COLS:
+            out[c] = pd.to_datetime(df[c]) if c in df.columns else pd.Series(pd.NaT, index=df.index, dtype="datetime64[us]")
+        else:
+            out[c] = df[c].astype(str).to_numpy() if c in df.columns else np.full(n, "", dtype=object)
+    return pd.DataFrame(out, index=df.index, columns=EXPORT_COLUMNS)
+
+def fin_export_frames(branches: list[str] = FIN_BRANCHES, months: list[str] = FIN_MONTHS_FR,
+                      kinds: tuple = ("Revenus", "Dépenses"), chunk: int = EXPORT_CHUNK_TABS):
+    # ورقة بورقة (batchGet بـchunk أوراق): اللي في الكاش يتقرا منو (بعد delta sync كان فات الـTTL، ومن غير
+    # الأسطر المعلّقة)، والباقي يتجاب وما يتخزّنش
+    available = set(sheet_meta().titles())
+    wanted = [(b, m, k, fin_month_title(m, k, b)) for b in branches for m in months for k in kinds]
+    wanted = [w for w in wanted if w[3] in available]
+    for i in range(0, len(wanted), chunk):
+        part = wanted[i:i+chunk]
+        cached = values_cache().confirmed_many([t for *_, t in part], lambda ts: batch_get_values(get_spreadsheet(), ts),
+                                               FIN_VALUES_TTL, fin_delta_sync_many)
+        missing = [t for *_, t in part if t not in cached]
+        fetched = batch_get_values(get_spreadsheet(), missing) if missing else {}
+        for b, m, k, t in part:
+            df = typed_frames().get(t, k, cached[t]) if t in cached else fin_parse_values(fetched.get(t) or [], k)
+            if not df.empty:
+                yield _export_frame(df, b, m, k)
+        del fetched
+
+class _CsvSink:
+    def __init__(self, path: str):
+        self.f = open(path, "w", encoding="utf-8-sig", newline="")
+        self.header = True
+
+    def write(self, df: pd.DataFrame):
+        df.to_csv(self.f, index=False, header=self.header, date_format="%d/%m/%Y")
+        self.header = False
+
+    def close(self):
+        if self.header:
+            pd.DataFrame(columns=EXPORT_COLUMNS).to_csv(self.f, index=False)
+        self.f.close()
+
+class _XlsxSink:
+    # openpyxl write_only: الأسطر تتكتب للقرص وما تتخزّنش في الذاكرة
+    def __init__(self, path: str):
+        from openpyxl import Workbook
+        self.path, self.wb = path, Workbook(write_only=True)
+        self.ws, self.rows, self.sheets = None, 0, 0
+
+    def _new_sheet(self):
+        self.sheets += 1
+        self.ws = self.wb.create_sheet("Finance" if self.sheets == 1 else f"Finance ({self.sheets})")
+        self.ws.append(EXPORT_COLUMNS)
+        self.rows = 0
+
+    def write(self, df: pd.DataFrame):
+        for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            if self.ws is None or self.rows >= EXPORT_XLSX_MAX_ROWS:
+                self._new_sheet()
+            self.ws.append(row)
+            self.rows += 1
+
+    def close(self):
+        if self.ws is None:
+            self._new_sheet()
+        self.wb.save(self.path)
+
+class _ParquetSink:
+    def __init__(self, path: str):
+        import pyarrow as pa, pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([(c, pa.float64() if c in FIN_AMOUNT_COLS else pa.timestamp("us") if c in FIN_DATE_COLS
+                                  else pa.string()) for c in EXPORT_COLUMNS])
+        self.w = pq.ParquetWriter(path, self.schema)
+
+    def write(self, df: pd.DataFrame):
+        self.w.write_table(self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False, safe=False))
+
+    def close(self):
+        self.w.close()
+
+_EXPORT_SINKS = {"csv": _CsvSink, "xlsx": _XlsxSink, "parquet": _ParquetSink}
+
+@traced("fin_export_year")
+def fin_export_year(fmt: str, branches: list[str] = FIN_BRANCHES, months: list[str] = FIN_MONTHS_FR,
+                    kinds: tuple = ("Revenus", "Dépenses")) -> bytes:
+    # كل أوراق العام (فروع × أشهر × نوع) في ملف واحد مكتوب chunk بـchunk في ملف مؤقت (الـDataFrames ما تتجمّعش)؛
+    # st.download_button يحتاج البايتات الكل، فنرجعوهم ونفسخو الملف
+    fd, path = tempfile.mkstemp(prefix="megacrm_export_", suffix="." + fmt)
+    os.close(fd)
+    try:
+        sink = _EXPORT_SINKS[fmt](path)
+        try:
+            for df in fin_export_frames(branches, months, kinds):
+                sink.write(df)
+        finally:
+            sink.close()
+        with open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+# ============ Payments Ledger ============
+_PHONE_RUN_RE = re.compile(r"\d{8,}")
+
+class PaymentLedger:
+    # فهرس الدفعات عبر كل أشهر Revenue: رقم الهاتف (من Note) / Libellé -> أرقام الأسطر في كل ورقة.
+    # يتبنى لكل ورقة مرّة، ومن بعد يتزاد كان الأسطر الجديدة (append) — تعديل من برّا = إعادة بناء الورقة هاذيكا برك.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._titles = {}  # title -> {"n", "last", "header", "by_phone", "by_lib"}
+
+    def _index_rows(self, idx: dict, rows: list[list[str]], start: int):
+        header = idx["header"]
+        i_lib = header.index("Libellé") if "Libellé" in header else None
+        i_note = header.index("Note") if "Note" in header else None
+        for pos, r in enumerate(rows, start):
+            if i_lib is not None and i_lib < len(r):
+                idx["by_lib"].setdefault(r[i_lib].strip().lower(), []).append(pos)
+            if i_note is not None and i_note < len(r):
+                for ph in {normalize_tn_phone(d) for d in _PHONE_RUN_RE.findall(r[i_note])}:
+                    idx["by_phone"].setdefault(ph, []).append(pos)
+
+    def _sync_values(self, title: str, values: list[list[str]]) -> dict:
+        with self._lock:
+            idx = self._titles.get(title)
+            n = len(values)
+            if idx is not None and idx["n"] == n and (n == 0 or values[-1] is idx["last"] or values[-1] == idx["last"]):
+                return idx
+            appended = (idx is not None and 0 < idx["n"] <= n and values[0] == idx["header"]
+                        and values[idx["n"]-1] == idx["last"])
+            if not appended:
+                idx = {"n": 1, "last": None, "header": list(values[0]) if values else [], "by_phone": {}, "by_lib": {}}
+            if n > idx["n"]:
+                self._index_rows(idx, values[idx["n"]:], idx["n"])
+            idx["n"], idx["last"] = max(n, 1), (values[-1] if values else None)
+            self._titles[title] = idx
+            return idx
+
+    def sync(self, title: str):
+        values = values_cache().peek(title)
+        if values is not None:
+            self._sync_values(title, values)
+
+    def lookup(self, branch: str, tel: str, libelle: str) -> pd.DataFrame:
+        titles = [fin_month_title(m, "Revenus", branch) for m in FIN_MONTHS_FR]
+        months = {t: m for m, t in zip(FIN_MONTHS_FR, titles)}
+        available = set(sheet_meta().titles())
+        titles = [t for t in titles if t in available]
+        values = fin_values_many(titles)
+        lib_key, out = libelle.strip().lower(), []
+        for t in titles:
+            vals = values.get(t) or []
+            if len(vals) < 2:
+                continue
+            idx = self._sync_values(t, vals)
+            hits = sorted(set(idx["by_phone"].get(tel, [])) | set(idx["by_lib"].get(lib_key, [])))
+            if not hits:
+                continue
+            sub = fin_parse_values([vals[0]] + [vals[i] for i in hits], "Revenus")
+            sub["__mois"] = months[t]
+            sub["__sheet_title"] = t
+            out.append(sub)
+        prev_df = pd.concat(out, ignore_index=True) if out else pd.DataFrame(columns=FIN_REV_COLUMNS+["__sheet_title","__mois"])
+        return prev_df.loc[:, ~prev_df.columns.duplicated()]
+
+@st.cache_resource(show_spinner=False)
+def payment_ledger() -> PaymentLedger:
+    return PaymentLedger()
+
+# ============ Bulk Import ============
+FIN_IMPORT_REQUIRED = {"Revenus": ["Date","Libellé","Prix","Montant_Admin","Montant_Structure"],
+                       "Dépenses": ["Date","Libellé","Montant","Caisse_Source"]}
+
+def fin_read_upload(file) -> pd.DataFrame:
+    # CSV (فاصل , ولا ;) ولا XLSX -> كل الخلايا نص، كيف القيم اللي تجي من Sheets
+    if file.name.lower().endswith(".xlsx"):
+        raw = pd.read_excel(file)
+        for c in raw.columns:
+            if pd.api.types.is_datetime64_any_dtype(raw[c]):
+                raw[c] = raw[c].dt.strftime("%d/%m/%Y")
+            elif raw[c].dtype == object:  # عمود فيه تواريخ ونص مع بعضهم: كل خلية تاريخ وحدها
+                raw[c] = raw[c].map(lambda v: v.strftime("%d/%m/%Y") if isinstance(v, (datetime, date)) and pd.notna(v) else v)
+    else:
+        raw = pd.read_csv(file, dtype=str, keep_default_na=False, sep=None, engine="python", encoding="utf-8-sig")
+    raw.columns = [str(c).strip() for c in raw.columns]
+    raw = raw.astype(object).where(raw.notna(), "")
+    return raw.apply(lambda s: s.astype(str).str.strip()).reset_index(drop=True)
+
+def fin_validate_import(raw: pd.DataFrame, kind: str, year: int|None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # نفس قواعد الفورم على الملف كامل مرّة وحدة (vectorized).
+    # ترجع (الأسطر الصالحة: مبالغ float وتواريخ datetime، الأخطاء: رقم السطر في الملف + السبب)
+    # أوراق الأشهر ما فيهاش عام (= العام الحالي): سطر من عام آخر يتخلط مع نفس الشهر -> مرفوض
+    cols = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
+    year = year or date.today().year
+    df = raw.reindex(columns=cols, fill_value="")
+    checks = []
+    dates = _parse_dates(df["Date"])
+    checks.append((dates.isna(), "Date غير صالحة"))
+    checks.append((dates.notna() & (dates.dt.year != year), f"Date خارج عام {year}"))
+    checks.append((df["Libellé"] == "", "Libellé مطلوب"))
+    nums = {}
+    for c in [c for c in cols if c in FIN_AMOUNT_COLS]:
+        v = _parse_amounts(df[c])
+        checks.append((v.isna() & (df[c] != ""), f"{c} موش رقم"))
+        nums[c] = v.fillna(0.0)
+    if kind == "Revenus":
+        total = nums["Montant_Admin"] + nums["Montant_Structure"]
+        checks.append((nums["Prix"] <= 0, "Prix مطلوب (> 0)"))
+        checks.append(((total <= 0) & (nums["Montant_PreInscription"] <= 0), "المبلغ لازم > 0"))
+        checks.append(((df["Montant_Total"] != "") & ((nums["Montant_Total"] - total).abs() > 0.005),
+                       "Montant_Total ≠ Admin + Structure"))
+        nums["Montant_Total"] = total
+        ech = _parse_dates(df["Echeance"])
+        checks.append((ech.isna() & (df["Echeance"] != ""), "Echeance غير صالحة"))
+    else:
+        checks.append((nums["Montant"] <= 0, "المبلغ لازم > 0"))
+        checks.append((~df["Caisse_Source"].isin(FIN_CAISSE_SOURCES), "Caisse_Source غير معروفة"))
+    msgs = pd.Series("", index=df.index)
+    for mask, msg in checks:
+        msgs = msgs + np.where(mask, msg + " · ", "")
+    bad = msgs != ""
+    errors = pd.DataFrame({"السطر": df.index[bad] + 2, "Libellé": df["Libellé"][bad],
+                           "الخطأ": msgs[bad].str.rstrip(" ·")}).reset_index(drop=True)
+    ok = df[~bad].assign(**{c: v[~bad] for c, v in nums.items()}, Date=dates[~bad])
+    if kind == "Revenus":
+        ok["Echeance"] = ech[~bad]  # فارغة تبقى فارغة: المستحقّات تحسبها "بدون Echeance"
+    ok["Mode"] = ok["Mode"].replace("", FIN_MODES[0])
+    ok["Catégorie"] = ok["Catégorie"].replace("", "Revenus" if kind == "Revenus" else "Achat")
+    return ok, errors
+
+def _client_keys(libelle: pd.Series, note: pd.Series) -> pd.Series:
+    # مفتاح العميل: الهاتف من Note (ClientTel:...)، وإلا هاتف عرفناه لنفس Libellé في سطر آخر، وإلا Libellé
+    phone = normalize_tn_phone_series(note.str.extract(r"(\d{8,})", expand=False))
+    lib = libelle.fillna("").astype(str).str.strip().str.lower()
+    has = phone != ""
+    by_lib = pd.Series(phone[has].to_numpy(), index=lib[has].to_numpy())
+    by_lib = by_lib[~by_lib.index.duplicated(keep="last")]
+    return phone.where(has, lib.map(by_lib)).fillna("lib:" + lib)
+
+def fin_import_reste(rows: pd.DataFrame, branch: str) -> pd.Series:
+    # Reste = Prix - كل ما دفعو العميل حتى لتاريخ السطر: كل أشهر الفرع + أسطر الملف اللي قبلو
+    hist = consolidate_fin("Revenus", [branch])
+    both = pd.DataFrame({
+        "lib":  pd.concat([hist["Libellé"].astype(str), rows["Libellé"]], ignore_index=True),
+        "note": pd.concat([hist["Note"].astype(str), rows["Note"]], ignore_index=True),
+        "date": pd.concat([hist["Date"], rows["Date"]], ignore_index=True),
+        "paid": pd.concat([hist["Montant_Total"], rows["Montant_Total"]], ignore_index=True).astype("float64"),
+        "new":  np.r_[np.zeros(len(hist), bool), np.ones(len(rows), bool)],
+    })
+    both["key"] = _client_keys(both["lib"], both["note"])
+    both = both.sort_values(["key", "date"], kind="stable")
+    paid = both["paid"].groupby(both["key"], sort=False).cumsum()[both["new"]].sort_index().to_numpy()
+    return pd.Series(np.maximum(rows["Prix"].to_numpy("float64") - paid, 0.0), index=rows.index)
+
+def fin_import(rows: pd.DataFrame, kind: str, branch: str, owner: str = "") -> dict[str, int]:
+    # كل سطر يمشي لورقة الشهر متاع تاريخو؛ كل ورقة = append_rows واحد (WriteQueue يجمّع)
+    cols = FIN_REV_COLUMNS if kind == "Revenus" else FIN_DEP_COLUMNS
+    rows = rows.sort_values("Date", kind="stable")
+    if kind == "Revenus":
+        rows = rows.assign(Reste=fin_import_reste(rows, branch))
+    out = rows[cols].copy()
+    for c in [c for c in cols if c in FIN_AMOUNT_COLS]:
+        out[c] = rows[c].map("{:.2f}".format)
+    for c in [c for c in cols if c in FIN_DATE_COLS]:
+        out[c] = rows[c].dt.strftime("%d/%m/%Y").fillna("")
+    titles = {m: fin_month_title(FIN_MONTHS_FR[m-1], kind, branch) for m in rows["Date"].dt.month.unique()}
+    counts = {}
+    for m, part in out.groupby(rows["Date"].dt.month.to_numpy(), sort=True):
+        write_queue().submit_many(titles[m], part.to_dict("records"), kind, owner)
+        counts[titles[m]] = len(part)
+    return counts
+
+# ============ Receivables ============
+RECEIVABLE_BUCKETS = ["لم يحن", "اليوم", "1–7 أيام", "8–30 يوم", "+30 يوم"]
+_RECEIVABLE_BINS   = [-np.inf, -1, 0, 7, 30, np.inf]  # أيام التأخير (اليوم - Echeance)
+
+def fin_receivables_frame(rev: pd.DataFrame, today: pd.Timestamp) -> pd.DataFrame:
+    # سطر لكل عميل (فرع + مفتاح العميل): آخر دفعة عبر كل الأشهر، Reste متاعها وقدّاش متأخر
+    cols = ["Branche","Client","Tel","Mois","Date","Echeance","Prix","Payé","Reste","Jours","Bucket","Employé"]
+    if rev.empty:
+        return pd.DataFrame(columns=cols).assign(Bucket=pd.Categorical([], categories=RECEIVABLE_BUCKETS))
+    keys = rev["Branche"].astype(str) + "|" + _client_keys(rev["Libellé"].astype(str), rev["Note"].astype(str))
+    df = rev.assign(__key=keys.to_numpy(), __pos=np.arange(len(rev)))
+    paid = df.groupby("__key")["Montant_Total"].sum()
+    last = df.sort_values(["__key", "Date", "__pos"], na_position="first", kind="stable").drop_duplicates("__key", keep="last")
+    last = last[last["Reste"] > 0]
+    days = (today - last["Echeance"].dt.normalize()).dt.days
+    bucket = pd.cut(days, bins=_RECEIVABLE_BINS, labels=RECEIVABLE_BUCKETS)
+    tel = last["__key"].str.split("|", n=1).str[1]
+    out = pd.DataFrame({
+        "Branche": last["Branche"], "Client": last["Libellé"], "Tel": tel.where(~tel.str.startswith("lib:"), ""),
+        "Mois": last["Mois"], "Date": last["Date"], "Echeance": last["Echeance"], "Prix": last["Prix"],
+        "Payé": last["__key"].map(paid), "Reste": last["Reste"], "Jours": days.clip(lower=0),
+        "Bucket": bucket, "Employé": last["Employé"],
+    })
+    return out.sort_values(["Jours", "Reste"], ascending=False, na_position="last").reset_index(drop=True)
+
+class Receivables:
+    # المستحقّات عبر كل أوراق Revenue (الفروع × الأشهر)، تتحسب مرّة لكل (نسخ الأوراق، اليوم) وتتخدم من الذاكرة
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._memo = {}  # tuple(branches) -> (key, frame)
+
+    def get(self, branches: list[str] = FIN_BRANCHES) -> pd.DataFrame:
+        available = set(sheet_meta().titles())
+        titles = [t for b in branches for m in FIN_MONTHS_FR if (t := fin_month_title(m, "Revenus", b)) in available]
+        fin_values_many(titles)
+        key = (date.today(), values_cache().versions(titles))
+        hit = self._memo.get(tuple(branches))
+        if hit is not None and hit[0] == key:
+            return hit[1]
+        frame = fin_receivables_frame(consolidate_fin("Revenus", branches), pd.Timestamp.now().normalize())
+        with self._lock:
+            self._memo[tuple(branches)] = (key, frame)
+        return frame
+
+    def warm(self):
+        # للـrefresher: كان حد فتح اللوحة، نخلّيوها جاهزة
+        for branches in list(self._memo):
+            self.get(list(branches))
+
+@st.cache_resource(show_spinner=False)
+def receivables() -> Receivables:
+    return Receivables()
+
+# ============ Load Clients/Employees ============
+def is_client_sheet_title(title: str) -> bool:
+    t = title.strip()
+    if is_fin_title(t): return False
+    if t.endswith("_PAIEMENTS") or t.startswith("_"): return False
+    return t not in (REASSIGN_LOG_SHEET,)
+
+def client_sheet_titles() -> list[str]:
+    return [t for t, tab in sheet_meta().tabs().items()
+            if is_client_sheet_title(t) and tab["header"][:len(EXPECTED_HEADERS_CLIENTS)] == EXPECTED_HEADERS_CLIENTS]
+
+def employee_names() -> list[str]:
+    # أسماء الموظفين من الـmetadata برك (عناوين الأوراق + السطر 1)، بلا ما نحمّلو العملاء الكل
+    return [t.strip() for t in client_sheet_titles()]
+
+@st.cache_resource(show_spinner=False)
+def _clients_frame_memo() -> dict:
+    return {}
+
+@traced("load_all_clients")
+def load_all_clients():
+    titles = client_sheet_titles()
+    # Reassign_Log يتجاب في نفس الـbatch متاع العملاء (للـPhoneIndex)
+    log = [REASSIGN_LOG_SHEET] if sheet_meta().get(REASSIGN_LOG_SHEET) is not None else []
+    values = values_cache().get_many(titles + log, lambda ts: batch_get_values(get_spreadsheet(), ts), ttl=CLIENTS_TTL, group="clients")
+    memo, key = _clients_frame_memo(), (tuple(titles + log), values_cache().versions(titles + log))
+    state = memo.get("state")
+    if state is None or state["key"] != key:
+        big, employees = _build_clients_frame(titles, values)
+        # الإطار والفهارس يتنشرو في assignment واحد: جلسة أخرى ما تشوفش frame جديد مع فهارس قدام
+        state = memo["state"] = {"key": key, "value": (big, employees), "picker": _build_picker_index(big),
+                                 "phones": PhoneIndex(big, values.get(REASSIGN_LOG_SHEET, []))}
+    return state["value"]
+
+def client_picker_index(big: pd.DataFrame) -> dict:
+    # {"label": key -> نص الاختيار, "pos": key -> رقم السطر في big}، يتحسب مرّة مع كل تحميل للعملاء
+    memo = _clients_frame_memo()
+    state = memo.get("state")
+    if state is not None and state["value"][0] is big:
+        return state["picker"]
+    return _build_picker_index(big)
+
+def _build_picker_index(big: pd.DataFrame) -> dict:
+    keys, labels = big["__key"].tolist(), big["__label"].tolist()
+    return {"label": dict(zip(keys, labels)), "pos": {k: i for i, k in enumerate(keys)}}
+
+def phone_index(big: pd.DataFrame) -> "PhoneIndex":
+    # نفس فكرة client_picker_index: مبني مرّة مع كل تحميل للعملاء
+    memo = _clients_frame_memo()
+    state = memo.get("state")
+    if state is not None and state["value"][0] is big:
+        return state["phones"]
+    return PhoneIndex(big, [])
+
+def client_duplicates(across_only: bool = False) -> pd.DataFrame:
+    big, _ = load_all_clients()
+    return phone_index(big).duplicates(across_only)
+
+class PhoneIndex:
+    # Tel_norm -> أسطر big (كل أوراق الموظفين) + تاريخ النقل في Reassign_Log. الأسطر مرتّبة حسب الرقم في _order،
+    # وكل رقم عندو (بداية، عدد) فيها -> التثبّت من رقم O(1) والتقرير الكل vectorized
+    def __init__(self, big: pd.DataFrame, log_rows: list[list[str]]):
+        self.big = big
+        sheet = big["__sheet_name"]
+        self._sheet_codes, self._sheets = sheet.cat.codes.to_numpy(), list(sheet.cat.categories)
+        self._row = big["__row"].to_numpy()
+        tel = big["Tel_norm"]
+        codes, uniques = pd.factorize(tel.where(tel.str.len() >= 8))  # أرقام فارغة/ناقصة -> -1
+        valid = np.flatnonzero(codes >= 0)
+        self._counts = np.bincount(codes[valid], minlength=len(uniques))
+        self._order = valid[np.argsort(codes[valid], kind="stable")]
+        starts = np.cumsum(self._counts) - self._counts
+        self._slot = dict(zip(uniques.tolist(), zip(starts.tolist(), self._counts.tolist())))
+        self.moves = self._moves(log_rows)
+        self._dups = {}
+
+    @staticmethod
+    def _moves(rows: list[list[str]]) -> pd.DataFrame:
+        # رقم -> عدد مرّات النقل + آخر نقل "src → dst (timestamp)"
+        empty = pd.DataFrame({"moves": pd.Series(dtype="int64"), "last_move": pd.Series(dtype=str)})
+        if len(rows) < 2 or not set(REASSIGN_LOG_HEADERS) <= set(rows[0]):
+            return empty
+        log = pd.DataFrame(rows[1:], columns=rows[0])[REASSIGN_LOG_HEADERS]
+        log["tel"] = normalize_tn_phone_series(log["phone"])
+        log = log[log["tel"].str.len() >= 8]
+        if log.empty:
+            return empty
+        last = log.groupby("tel", sort=False).last()
+        return pd.DataFrame({"moves": log.groupby("tel", sort=False).size(),
+                             "last_move": last["src_employee"] + " → " + last["dst_employee"] + " (" + last["timestamp"] + ")"})
+
+    def rows(self, phone: str) -> np.ndarray:
+        slot = self._slot.get(normalize_tn_phone(phone))
+        return self._order[slot[0]:slot[0]+slot[1]] if slot else self._order[:0]
+
+    def locate(self, phone: str) -> list[tuple[str, int]]:
+        # [(ورقة الموظّف, رقم السطر)] لكل بلاصة فيها الرقم هذا
+        pos = self.rows(phone)
+        return [(self._sheets[c], int(r)) for c, r in zip(self._sheet_codes[pos], self._row[pos])]
+
+    def exists(self, phone: str, exclude_sheet: str|None = None) -> bool:
+        return any(sheet != exclude_sheet for sheet, _ in self.locate(phone))
+
+    def last_move(self, phone: str) -> str|None:
+        tel = normalize_tn_phone(phone)
+        return self.moves["last_move"].get(tel) if tel in self.moves.index else None
+
+    def duplicates(self, across_only: bool = False) -> pd.DataFrame:
+        # كل الأسطر اللي رقمها موجود أكثر من مرّة، مجمّعة حسب الرقم؛ across_only = كان بين أوراق مختلفة
+        if across_only not in self._dups:
+            self._dups[across_only] = self._duplicates(across_only)
+        return self._dups[across_only]
+
+    def _duplicates(self, across_only: bool) -> pd.DataFrame:
+        dup = self._counts > 1
+        pos = self._order[np.repeat(dup, self._counts)]
+        out = self.big.iloc[pos][["Tel_norm","Nom & Prénom","__sheet_name","__row","Formation","Inscription"]]
+        out = out.rename(columns={"Tel_norm": "Téléphone", "__sheet_name": "Employé", "__row": "Ligne"})
+        out["Nb"] = np.repeat(self._counts[dup], self._counts[dup])
+        out["Onglets"] = out.groupby("Téléphone", sort=False)["Employé"].transform("nunique")
+        out["Transferts"] = out["Téléphone"].map(self.moves["moves"]).fillna(0).astype("int64")
+        out["Dernier transfert"] = out["Téléphone"].map(self.moves["last_move"]).fillna("")
+        if across_only:
+            out = out[out["Onglets"] > 1]
+        return out.reset_index(drop=True)
+
+def clients_age() -> float|None:
+    ages = [values_cache().age(t) for t in client_sheet_titles()]
+    ages = [a for a in ages if a is not None]
+    return max(ages) if ages else None
+
+CLIENT_CATEGORY_COLS = ["Formation","Inscription"]
+
+def _categorical_map(s: pd.Series, fn) -> pd.Categorical:
+    # fn تتحسب على الـcategories (قليلة) مش على كل سطر، والنتيجة categorical زادة
+    cats, inv = np.unique(fn(pd.Series(s.cat.categories, dtype=str)).to_numpy(dtype=str), return_inverse=True)
+    return pd.Categorical.from_codes(inv[s.cat.codes.to_numpy()], categories=cats)
+
+def _build_clients_frame(titles: list[str], values: dict[str, list[list[str]]]):
+    # إطار واحد مشترك بين الجلسات وما يتبدّلش: أسطر الأوراق الكل -> DataFrame مرّة وحدة (بلا concat ونسخة ثانية)،
+    # والأعمدة اللي تتعاود (الموظّف/التكوين/التسجيل) categorical
+    n = len(EXPECTED_HEADERS_CLIENTS)
+    rows, employees, counts = [], [], []
+    for title in titles:
+        tab = values.get(title, [])
+        if not tab or tab[0][:n] != EXPECTED_HEADERS_CLIENTS:
+            continue
+        employees.append(title.strip())
+        counts.append(len(tab) - 1)
+        rows.extend(r[:n] for r in tab[1:])
+    big = pd.DataFrame(rows, columns=EXPECTED_HEADERS_CLIENTS)
+    del rows
+    names = list(dict.fromkeys(employees))
+    sheet_codes = np.repeat(np.array([names.index(e) for e in employees], dtype=np.int64), counts)
+    big["__sheet_name"] = pd.Categorical.from_codes(sheet_codes, categories=names)
+    for c in CLIENT_CATEGORY_COLS:
+        big[c] = big[c].fillna("").astype("category")
+    # أعمدة محسوبة مرّة وحدة (vectorized) للـpicker
+    big["Tel_norm"] = normalize_tn_phone_series(big["Téléphone"])
+    big["Inscr_norm"] = _categorical_map(big["Inscription"], lambda c: c.str.lower().str.strip())
+    starts = np.cumsum(counts, dtype=np.int64) - counts
+    big["__row"] = np.arange(len(big)) - np.repeat(starts, counts) + 2  # رقم السطر في ورقة الموظّف
+    big["__key"] = big["__sheet_name"].astype(str) + "#" + big["__row"].astype(str)
+    big["__label"] = (big["Nom & Prénom"].fillna("").astype(str) + " — +" + big["Tel_norm"] + " — "
+                      + big["Formation"].astype(str) + "  [" + big["__sheet_name"].astype(str) + "]")
+    return big, employees
+
+# ============ Background Refresher ============
+REFRESH_TICK   = 10  # ثواني بين دورتين
+REFRESH_MARGIN = 30  # نعاودو نقراو قبل ما يوفى الـTTL بـ30 ثانية
+
+def hot_fin_titles() -> list[str]:
+    mois = FIN_MONTHS_FR[datetime.now().month - 1]
+    return [fin_month_title(mois, k, b) for b in FIN_BRANCHES for k in ("Revenus", "Dépenses")]
+
+class BackgroundRefresher:
+    # thread واحد في الـprocess: الشهر الحالي (الفرعين) + العملاء + metadata ديما سخونين،
+    # والـreruns تقرا من الذاكرة وما تستنّى Sheets أبدًا
+    def __init__(self):
+        self.last_tick = None
+        self.errors = {}
+        self._thread = threading.Thread(target=self._loop, name="megacrm-refresher", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        _call_ctx.background = True
+        while True:
+            time.sleep(REFRESH_TICK)
+            self.tick()
+
+    def _guard(self, key, fn):
+        try:
+            fn()
+            self.errors.pop(key, None)
+        except Exception as e:
+            self.errors[key] = f"{type(e).__name__}: {e}"
+
+    def tick(self):
+        vc, meta = values_cache(), sheet_meta()
+        for title in hot_fin_titles():
+            self._guard(title, lambda: vc.refresh_if_due(title, REFRESH_MARGIN))
+        self._guard("clients", lambda: vc.refresh_group_if_due("clients", REFRESH_MARGIN))
+        self._guard("receivables", receivables().warm)
+        age = meta.age()
+        if age is not None and age > META_TTL - REFRESH_MARGIN:
+            self._guard("meta", lambda: single_flight().do(("meta",), meta.refresh))
+        self.last_tick = time.time()
+
+@st.cache_resource(show_spinner=False)
+def background_refresher() -> BackgroundRefresher:
+    return BackgroundRefresher()
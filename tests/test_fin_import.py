@@ -0,0 +1,31 @@
+import io
+from datetime import datetime
+
+import pandas as pd
+
+import megacrm_core as core
+
+
+def _xlsx(df: pd.DataFrame) -> io.BytesIO:
+    buf = io.BytesIO()
+    df.to_excel(buf, index=False)
+    buf.seek(0)
+    buf.name = "ops.xlsx"
+    return buf
+
+
+def test_read_upload_formats_dates_in_mixed_type_column():
+    raw = core.fin_read_upload(_xlsx(pd.DataFrame({
+        "Date": [datetime(2026, 3, 5), "06/03/2026"],
+        "Libellé": ["A", "B"],
+        "Echeance": [datetime(2026, 4, 1), ""],
+    })))
+    assert raw["Date"].tolist() == ["05/03/2026", "06/03/2026"]
+    assert raw["Echeance"].tolist() == ["01/04/2026", ""]
+    assert core._parse_dates(raw["Date"]).dt.month.tolist() == [3, 3]
+
+
+def test_parse_dates_keeps_iso_month():
+    d = core._parse_dates(pd.Series(["2026-03-05 00:00:00", "05-03-2026", ""]))
+    assert d.dt.month.tolist()[:2] == [3, 3]
+    assert d.isna().tolist() == [False, False, True]